@@ -14,27 +14,44 @@
 #settings
 gDefaultSizeWidth = 320
 gDefaultSizeHeight = 240
+gDefaultServerAddress = '127.0.0.1:7398'
 #settings end
 
-import argparse
-import calendar
-import gettext
+import array
+import bisect
+import contextlib
+import functools
 import io
-import json
+import itertools
 import logging
 import math
 import os
-import random
 import re
 import sys
+import threading
 import time
-import xml.dom.minidom
+import unicodedata
+import zlib
+
+# Other modules are imported where they are used, so that starting the
+# command line or importing this module does not pay for the modules the
+# conversion at hand does not need.  test/test-startup.py checks this.
 
 
 if sys.version_info < (3,):
     raise RuntimeError('at least Python 3.0 is required')
 
-gettext.install('danmaku2ass', os.path.join(os.path.dirname(os.path.abspath(os.path.realpath(sys.argv[0] or 'locale'))), 'locale'))
+
+def _(message):
+    # Load the translations once the first message is shown
+    global _
+    import gettext
+    _ = gettext.translation('danmaku2ass', os.path.join(os.path.dirname(os.path.abspath(os.path.realpath(sys.argv[0] or 'locale'))), 'locale'), fallback=True).gettext
+    return _(message)
+
+
+def DefaultFontFace():
+    return _('(FONT) sans-serif')[7:]
 
 
 def SeekZero(function):
@@ -101,6 +118,9 @@ def ProbeCommentFormat(f):
                     return 'MioMio'
         elif tmp == 'p':
             return 'Niconico'  # Himawari Douga, with the same file format as Niconico Douga
+    elif tmp == ArchiveMagic[:1].decode('ascii'):
+        if f.read(len(ArchiveMagic) - 1) == ArchiveMagic[1:].decode('ascii'):
+            return 'Archive'
 
 
 #
@@ -129,15 +149,19 @@ def ProbeCommentFormat(f):
 #     width:     The estimated width in pixels
 #                i.e. CalculateLength(comment)*size
 #
+# Comments that can not be read are reported with ReportInvalidComment,
+# which logs them and counts them in the stats of the conversion.
+#
 # After implementing ReadComments****, make sure to update ProbeCommentFormat
-# and CommentFormatMap.
+# and CommentFormatMap.  Readers shipped in other packages can instead be
+# registered under the 'danmaku2ass.readers' entry point group and selected
+# with --format.
 #
 
 
 def ReadCommentsNiconicoYtdlpJson(f, fontsize):
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
-    json_list = json.load(f)
-    for json_dict in json_list:
+    for json_dict in IterJSONArray(f):
         if len(json_dict) != 1:
             logging.warning(_('Rare json: %s') % str(json_dict))
             continue
@@ -176,8 +200,7 @@ def ReadCommentsNiconicoYtdlpJson(f, fontsize):
 
 def ReadCommentsNiconicoYtdlpJson2(f, fontsize):
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
-    json_list = json.load(f)
-    for value in json_list:
+    for value in IterJSONArray(f):
         comment = value['body']
         pos = 0
         color = 0xffffff
@@ -203,18 +226,18 @@ def ReadCommentsNiconicoYtdlpJson2(f, fontsize):
 
 
 def ReadCommentsNiconico(f, fontsize):
+    import xml.etree.ElementTree
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('chat')
-    for comment in comment_element:
+    for comment in IterXMLElements(f, 'chat'):
         try:
-            c = str(comment.childNodes[0].wholeText)
+            c = comment.text
+            assert c is not None
             if c.startswith('/'):
                 continue  # ignore advanced comments
             pos = 0
             color = 0xffffff
             size = fontsize
-            for mailstyle in str(comment.getAttribute('mail')).split():
+            for mailstyle in comment.get('mail', '').split():
                 if mailstyle == 'ue':
                     pos = 1
                 elif mailstyle == 'shita':
@@ -225,14 +248,14 @@ def ReadCommentsNiconico(f, fontsize):
                     size = fontsize * 0.64
                 elif mailstyle in NiconicoColorMap:
                     color = NiconicoColorMap[mailstyle]
-            timeline = max(int(comment.getAttribute('vpos')), 0) * 0.01
-            timestamp = int(comment.getAttribute('date'))
-            no = int(comment.getAttribute('no'))
+            timeline = max(int(comment.get('vpos', '')), 0) * 0.01
+            timestamp = int(comment.get('date', ''))
+            no = int(comment.get('no', ''))
             height = (c.count('\n') + 1) * size
             width = CalculateLength(c) * size
             yield (timeline, timestamp, no, c, pos, color, size, height, width)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            ReportInvalidComment(_('Invalid comment: %s') % xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
 
 
@@ -240,9 +263,8 @@ def ReadCommentsAcfun(f, fontsize):
     #comment_element = json.load(f)
     # after load acfun comment json file as python list, flatten the list
     #comment_element = [c for sublist in comment_element for c in sublist]
-    comment_elements = json.load(f)
-    comment_element = comment_elements[2]
-    for i, comment in enumerate(comment_element):
+    import json
+    for i, comment in enumerate(IterJSONArray(f, (2,))):
         try:
             p = str(comment['c']).split(',')
             assert len(p) >= 6
@@ -255,60 +277,60 @@ def ReadCommentsAcfun(f, fontsize):
                 c = dict(json.loads(comment['m']))
                 yield (float(p[0]), int(p[5]), i, c, 'acfunpos', int(p[1]), size, 0, 0)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %r') % comment)
+            ReportInvalidComment(_('Invalid comment: %r') % comment)
             continue
 
 
-def ReadCommentsBilibili(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+def ReadCommentsBilibili(f, fontsize, row_ids=False):
+    # With row_ids, the row id given by the site, or None, is appended to
+    # each comment for DuplicateFilter
+    import xml.etree.ElementTree
+    for i, comment in enumerate(IterXMLElements(f, 'd')):
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = comment.get('p', '').split(',')
             assert len(p) >= 5
             assert p[1] in ('1', '4', '5', '6', '7', '8')
-            if comment.childNodes.length > 0:
+            row_id = (int(p[7]) if len(p) >= 8 and p[7].isdigit() else None,) if row_ids else ()
+            if comment.text is not None:
                 if p[1] in ('1', '4', '5', '6'):
-                    c = str(comment.childNodes[0].wholeText).replace('/n', '\n')
+                    c = comment.text.replace('/n', '\n')
                     size = int(p[2]) * fontsize / 25.0
-                    yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+                    yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size) + row_id
                 elif p[1] == '7':  # positioned comment
-                    c = str(comment.childNodes[0].wholeText)
-                    yield (float(p[0]), int(p[4]), i, c, 'bilipos', int(p[3]), int(p[2]), 0, 0)
+                    c = comment.text
+                    yield (float(p[0]), int(p[4]), i, c, 'bilipos', int(p[3]), int(p[2]), 0, 0) + row_id
                 elif p[1] == '8':
                     pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            ReportInvalidComment(_('Invalid comment: %s') % xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
 
 
 def ReadCommentsBilibili2(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+    import xml.etree.ElementTree
+    for i, comment in enumerate(IterXMLElements(f, 'd')):
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = comment.get('p', '').split(',')
             assert len(p) >= 7
             assert p[3] in ('1', '4', '5', '6', '7', '8')
-            if comment.childNodes.length > 0:
+            if comment.text is not None:
                 time = float(p[2]) / 1000.0
                 if p[3] in ('1', '4', '5', '6'):
-                    c = str(comment.childNodes[0].wholeText).replace('/n', '\n')
+                    c = comment.text.replace('/n', '\n')
                     size = int(p[4]) * fontsize / 25.0
                     yield (time, int(p[6]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[3]], int(p[5]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
                 elif p[3] == '7':  # positioned comment
-                    c = str(comment.childNodes[0].wholeText)
+                    c = comment.text
                     yield (time, int(p[6]), i, c, 'bilipos', int(p[5]), int(p[4]), 0, 0)
                 elif p[3] == '8':
                     pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            ReportInvalidComment(_('Invalid comment: %s') % xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
 
 
 def ReadCommentsTudou(f, fontsize):
-    comment_element = json.load(f)
-    for i, comment in enumerate(comment_element['comment_list']):
+    for i, comment in enumerate(IterJSONArray(f, ('comment_list',))):
         try:
             assert comment['pos'] in (3, 4, 6)
             c = str(comment['data'])
@@ -316,13 +338,13 @@ def ReadCommentsTudou(f, fontsize):
             size = {0: 0.64, 1: 1, 2: 1.44}[comment['size']] * fontsize
             yield (int(comment['replay_time'] * 0.001), int(comment['commit_time']), i, c, {3: 0, 4: 2, 6: 1}[comment['pos']], int(comment['color']), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %r') % comment)
+            ReportInvalidComment(_('Invalid comment: %r') % comment)
             continue
 
 
 def ReadCommentsTudou2(f, fontsize):
-    comment_element = json.load(f)
-    for i, comment in enumerate(comment_element['result']):
+    import json
+    for i, comment in enumerate(IterJSONArray(f, ('result',))):
         try:
             c = str(comment['content'])
             prop = json.loads(str(comment['propertis']) or '{}')
@@ -336,29 +358,29 @@ def ReadCommentsTudou2(f, fontsize):
                 {0: 0, 3: 0, 4: 2, 6: 1}[pos],
                 int(prop.get('color', 0xffffff)), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %r') % comment)
+            ReportInvalidComment(_('Invalid comment: %r') % comment)
             continue
 
 
 def ReadCommentsMioMio(f, fontsize):
+    import calendar
+    import xml.etree.ElementTree
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffc000, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000}
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('data')
-    for i, comment in enumerate(comment_element):
+    for i, comment in enumerate(IterXMLElements(f, 'data')):
         try:
-            message = comment.getElementsByTagName('message')[0]
-            c = str(message.childNodes[0].wholeText)
+            message = comment.findall('.//message')[0]
+            c = message.text
+            assert c is not None
             pos = 0
-            size = int(message.getAttribute('fontsize')) * fontsize / 25.0
-            yield (float(comment.getElementsByTagName('playTime')[0].childNodes[0].wholeText), int(calendar.timegm(time.strptime(comment.getElementsByTagName('times')[0].childNodes[0].wholeText, '%Y-%m-%d %H:%M:%S'))) - 28800, i, c, {'1': 0, '4': 2, '5': 1}[message.getAttribute('mode')], int(message.getAttribute('color')), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+            size = int(message.get('fontsize', '')) * fontsize / 25.0
+            yield (float(comment.findall('.//playTime')[0].text), int(calendar.timegm(time.strptime(comment.findall('.//times')[0].text, '%Y-%m-%d %H:%M:%S'))) - 28800, i, c, {'1': 0, '4': 2, '5': 1}[message.get('mode', '')], int(message.get('color', '')), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            ReportInvalidComment(_('Invalid comment: %s') % xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
 
 
 def ReadCommentDanDanPlay(f, fontsize):
-    comment_element = json.load(f)
-    for i, comment_item in enumerate(comment_element['comments']):
+    for i, comment_item in enumerate(IterJSONArray(f, ('comments',))):
         try:
             timeline, pos, color, _user_id = comment_item['p'].split(',')
             timeline = float(timeline)
@@ -373,11 +395,232 @@ def ReadCommentDanDanPlay(f, fontsize):
             width = CalculateLength(comment) * size
             yield (timeline, timestamp, no, comment, pos, color, size, height, width)
         except:
-            logging.warning(_('Invalid comment: %r') % comment_item)
+            ReportInvalidComment(_('Invalid comment: %r') % comment_item)
             continue
 
 
-CommentFormatMap = {
+def ReadCommentsArchive(f, fontsize):
+    # f is read as binary, through its buffer if it is a text file
+    return iter(LoadCommentArchive(getattr(f, 'buffer', f), fontsize))
+
+
+def IterXMLElements(f, tag):
+    # Yield each <tag> element once it is fully parsed, then drop it from the
+    # tree, so that memory usage does not grow with the size of the file
+    import xml.etree.ElementTree
+    root = None
+    for event, element in xml.etree.ElementTree.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = element
+        elif event == 'end' and element.tag == tag:
+            element.tail = None
+            yield element
+            root.clear()
+
+
+def IterJSONArray(f, path=()):
+    # Yield the elements of the array found by following path, a sequence of
+    # object keys and array indexes, one at a time as they are decoded, so
+    # that memory usage does not grow with the size of the file
+    stream = JSONStream(f)
+    for key in path:
+        if isinstance(key, int):
+            stream.Expect('[')
+            for i in range(key):
+                if stream.Peek() == ']':
+                    raise IndexError(_('JSON array index out of range: %d') % key)
+                stream.Value()
+                if not stream.Separator(']'):
+                    raise IndexError(_('JSON array index out of range: %d') % key)
+        else:
+            stream.Expect('{')
+            if stream.Peek() == '}':
+                raise KeyError(key)
+            while True:
+                name = stream.Value()
+                stream.Expect(':')
+                if name == key:
+                    break
+                stream.Value()
+                if not stream.Separator('}'):
+                    raise KeyError(key)
+    stream.Expect('[')
+    yield from stream.Elements()
+
+
+class JSONStream(object):
+    # A JSON document read a chunk at a time, decoded value by value with
+    # JSONDecoder.raw_decode over a buffer that only holds the unread part
+
+    Whitespace = re.compile('[ \t\n\r]*')
+    NumberTail = re.compile('[0-9.eE+-]*')
+    ElementEnd = re.compile('[ \t\n\r]*([,\\]])')
+
+    def __init__(self, f, chunk_size=65536):
+        import json
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def Fill(self, size):
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+            return
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def Peek(self):
+        # Skip whitespace and return the next character, '' at the end
+        while True:
+            self.pos = self.Whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.Fill(self.chunk_size)
+
+    def Expect(self, c):
+        import json
+        if self.Peek() != c:
+            raise json.JSONDecodeError('Expecting %r' % c, self.buf, self.pos)
+        self.pos += 1
+
+    def Separator(self, close):
+        # Consume a comma and return True, or the closing bracket and return False
+        c = self.Peek()
+        if c == ',':
+            self.pos += 1
+            return True
+        self.Expect(close)
+        return False
+
+    def Value(self):
+        import json
+        self.Peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer may go on in the next chunk
+                if self.NumberTail.match(self.buf, end).end() < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # Read more at each retry, so that a long value is decoded a
+            # few times at most
+            self.Fill(size)
+            size *= 2
+
+    def Elements(self):
+        # Yield the values of an array whose opening bracket is consumed.
+        # Each value is decoded along with the separator after it, which
+        # also tells whether a number at the end of the buffer is complete.
+        if self.Peek() == ']':
+            self.pos += 1
+            return
+        scan_once = self.decoder.scan_once
+        size = self.chunk_size
+        while True:
+            pos = self.Whitespace.match(self.buf, self.pos).end()
+            try:
+                value, end = scan_once(self.buf, pos)
+                m = self.ElementEnd.match(self.buf, end)
+            except (StopIteration, ValueError):
+                m = None
+            if m is None:
+                if self.eof:
+                    # Let Value or Expect report what is wrong
+                    self.pos = pos
+                    self.Value()
+                    self.Expect(',')
+                self.Fill(size)
+                size *= 2
+                continue
+            size = self.chunk_size
+            self.pos = m.end()
+            yield value
+            if m.group(1) == ']':
+                return
+
+
+class DuplicateFilter(object):
+    # Drop comments already read from another input file, e.g. from another
+    # snapshot of the same video.  Comments are the same if their timeline,
+    # timestamp and text are, and their id: the comment number for the
+    # formats in CommentIdFormats, or the id appended by the readers of
+    # RowIdFormats.  Each call reads one file, and comments repeated within
+    # it are kept.  Only the keys are kept, along with the file they were
+    # first read from.
+
+    def __init__(self):
+        self.seen = {}
+        self.files = 0
+        self.dropped = 0
+
+    def __call__(self, comments, file_format):
+        import json
+        seen = self.seen
+        source = self.files
+        self.files += 1
+        with_id = file_format in CommentIdFormats
+        for c in comments:
+            # Acfun positioned comments are dicts
+            text = c[3] if isinstance(c[3], str) else json.dumps(c[3], sort_keys=True)
+            if len(c) > 9:
+                key = (c[0], c[1], text, c[9])
+                c = c[:9]
+            else:
+                key = (c[0], c[1], text, c[2]) if with_id else (c[0], c[1], text)
+            if seen.setdefault(key, source) != source:
+                self.dropped += 1
+                continue
+            yield c
+
+
+# Formats whose comment numbers are ids given by the site, not the position
+# of the comment in the file
+CommentIdFormats = frozenset(('Niconico', 'NiconicoYtdlpJson', 'NiconicoYtdlpJson2'))
+
+# Formats whose readers append the ids given by the site to the comments
+# when called with row_ids=True
+RowIdFormats = frozenset(('Bilibili',))
+
+
+class CommentFormatRegistry(dict):
+    # Maps format names to readers.  Names not built in are looked up, on
+    # first use, among the 'danmaku2ass.readers' entry points of installed
+    # packages; iterating lists only readers that are already loaded.
+
+    EntryPointGroup = 'danmaku2ass.readers'
+
+    def __missing__(self, name):
+        import importlib.metadata
+        entry_points = importlib.metadata.entry_points()
+        if hasattr(entry_points, 'select'):
+            entry_points = entry_points.select(group=self.EntryPointGroup)
+        else:
+            entry_points = entry_points.get(self.EntryPointGroup, ())
+        for entry_point in entry_points:
+            if entry_point.name == name:
+                reader = self[name] = entry_point.load()
+                return reader
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+CommentFormatMap = CommentFormatRegistry({
     'Niconico': ReadCommentsNiconico,
     'NiconicoYtdlpJson': ReadCommentsNiconicoYtdlpJson,
     'NiconicoYtdlpJson2': ReadCommentsNiconicoYtdlpJson2,
@@ -387,11 +630,13 @@ CommentFormatMap = {
     'Tudou': ReadCommentsTudou,
     'Tudou2': ReadCommentsTudou2,
     'MioMio': ReadCommentsMioMio,
-    'DanDanPlay': ReadCommentDanDanPlay
-}
+    'DanDanPlay': ReadCommentDanDanPlay,
+    'Archive': ReadCommentsArchive
+})
 
 
 def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
+    import json
     # BiliPlayerSize = (512, 384)  # Bilibili player version 2010
     # BiliPlayerSize = (540, 384)  # Bilibili player version 2012
     BiliPlayerSize = (672, 438)  # Bilibili player version 2014
@@ -451,10 +696,7 @@ def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
         if fontface:
             styles.append('\\fn%s' % ASSEscape(fontface))
         styles.append('\\fs%.0f' % (c[6] * ZoomFactor[0]))
-        if c[5] != 0xffffff:
-            styles.append('\\c&H%s&' % ConvertColor(c[5]))
-            if c[5] == 0x000000:
-                styles.append('\\3c&HFFFFFF&')
+        styles.append(GetColorStyle(c[5]))
         if from_alpha == to_alpha:
             styles.append('\\alpha&H%02X' % from_alpha)
         elif (from_alpha, to_alpha) == (255, 0):
@@ -468,9 +710,9 @@ def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
         f.write('Dialogue: -1,%(start)s,%(end)s,%(styleid)s,,0,0,0,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(c[0]), 'end': ConvertTimestamp(c[0] + lifetime), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
     except (IndexError, ValueError) as e:
         try:
-            logging.warning(_('Invalid comment: %r') % c[3])
+            ReportInvalidComment(_('Invalid comment: %r') % c[3])
         except IndexError:
-            logging.warning(_('Invalid comment: %r') % c)
+            ReportInvalidComment(_('Invalid comment: %r') % c)
 
 
 def WriteCommentAcfunPositioned(f, c, width, height, styleid):
@@ -584,33 +826,39 @@ def WriteCommentAcfunPositioned(f, c, width, height, styleid):
                 styles.append('\\t(%s)' % (''.join(action_styles)))
             FlushCommentLine(f, text, styles, c[0] + from_time, c[0] + from_time + action_time, styleid)
     except (IndexError, ValueError) as e:
-        logging.warning(_('Invalid comment: %r') % c[3])
+        ReportInvalidComment(_('Invalid comment: %r') % c[3])
 
 
 # Result: (f, dx, dy)
 # To convert: NewX = f*x+dx, NewY = f*y+dy
+@functools.lru_cache(maxsize=256)
 def GetZoomFactor(SourceSize, TargetSize):
-    try:
-        if (SourceSize, TargetSize) == GetZoomFactor.Cached_Size:
-            return GetZoomFactor.Cached_Result
-    except AttributeError:
-        pass
-    GetZoomFactor.Cached_Size = (SourceSize, TargetSize)
     try:
         SourceAspect = SourceSize[0] / SourceSize[1]
         TargetAspect = TargetSize[0] / TargetSize[1]
         if TargetAspect < SourceAspect:  # narrower
             ScaleFactor = TargetSize[0] / SourceSize[0]
-            GetZoomFactor.Cached_Result = (ScaleFactor, 0, (TargetSize[1] - TargetSize[0] / SourceAspect) / 2)
+            return (ScaleFactor, 0, (TargetSize[1] - TargetSize[0] / SourceAspect) / 2)
         elif TargetAspect > SourceAspect:  # wider
             ScaleFactor = TargetSize[1] / SourceSize[1]
-            GetZoomFactor.Cached_Result = (ScaleFactor, (TargetSize[0] - TargetSize[1] * SourceAspect) / 2, 0)
+            return (ScaleFactor, (TargetSize[0] - TargetSize[1] * SourceAspect) / 2, 0)
         else:
-            GetZoomFactor.Cached_Result = (TargetSize[0] / SourceSize[0], 0, 0)
-        return GetZoomFactor.Cached_Result
+            return (TargetSize[0] / SourceSize[0], 0, 0)
     except ZeroDivisionError:
-        GetZoomFactor.Cached_Result = (1, 0, 0)
-        return GetZoomFactor.Cached_Result
+        return (1, 0, 0)
+
+
+# (sin, cos) of the whole angles in degrees, as used by Bilibili mode 7
+SinCosTable = {deg: (math.sin(deg * (math.pi / 180.0)), math.cos(deg * (math.pi / 180.0))) for deg in range(-180, 181)}
+FlashFOVTangent = math.tan(2 * math.pi / 9.0)
+
+
+def SinCosDegrees(deg):
+    try:
+        return SinCosTable[deg]
+    except KeyError:
+        rad = deg * (math.pi / 180.0)
+        return (math.sin(rad), math.cos(rad))
 
 
 # Calculation is based on https://github.com/jabbany/CommentCoreLibrary/issues/5#issuecomment-40087282
@@ -618,29 +866,15 @@ def GetZoomFactor(SourceSize, TargetSize):
 # ASS FOV = width*4/3.0
 # But Flash FOV = width/math.tan(100*math.pi/360.0)/2 will be used instead
 # Result: (transX, transY, rotX, rotY, rotZ, scaleX, scaleY)
+# Animated comments repeat the same transforms over many events, so the
+# results are kept in a bounded LRU cache
+@functools.lru_cache(maxsize=16384)
 def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
-    def WrapAngle(deg):
-        return 180 - ((180 - deg) % 360)
-    rotY = WrapAngle(rotY)
-    rotZ = WrapAngle(rotZ)
-    if rotY in (90, -90):
-        rotY -= 1
-    if rotY == 0 or rotZ == 0:
-        outX = 0
-        outY = -rotY  # Positive value means clockwise in Flash
-        outZ = -rotZ
-        rotY *= math.pi / 180.0
-        rotZ *= math.pi / 180.0
-    else:
-        rotY *= math.pi / 180.0
-        rotZ *= math.pi / 180.0
-        outY = math.atan2(-math.sin(rotY) * math.cos(rotZ), math.cos(rotY)) * 180 / math.pi
-        outZ = math.atan2(-math.cos(rotY) * math.sin(rotZ), math.cos(rotZ)) * 180 / math.pi
-        outX = math.asin(math.sin(rotY) * math.sin(rotZ)) * 180 / math.pi
-    trX = (X * math.cos(rotZ) + Y * math.sin(rotZ)) / math.cos(rotY) + (1 - math.cos(rotZ) / math.cos(rotY)) * width / 2 - math.sin(rotZ) / math.cos(rotY) * height / 2
-    trY = Y * math.cos(rotZ) - X * math.sin(rotZ) + math.sin(rotZ) * width / 2 + (1 - math.cos(rotZ)) * height / 2
-    trZ = (trX - width / 2) * math.sin(rotY)
-    FOV = width * math.tan(2 * math.pi / 9.0) / 2
+    sinY, cosY, sinZ, cosZ, outX, outY, outZ = FlashRotationAngles(rotY, rotZ)
+    trX = (X * cosZ + Y * sinZ) / cosY + (1 - cosZ / cosY) * width / 2 - sinZ / cosY * height / 2
+    trY = Y * cosZ - X * sinZ + sinZ * width / 2 + (1 - cosZ) * height / 2
+    trZ = (trX - width / 2) * sinY
+    FOV = width * FlashFOVTangent / 2
     try:
         scaleXY = FOV / (FOV + trZ)
     except ZeroDivisionError:
@@ -653,95 +887,625 @@ def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
         outX += 180
         outY += 180
         logging.error('Rotation makes object behind the camera: trZ == %.0f < %.0f' % (trZ, FOV))
-    return (trX, trY, WrapAngle(outX), WrapAngle(outY), WrapAngle(outZ), scaleXY * 100, scaleXY * 100)
-
-
-def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, filters_regex, reduced, progress_callback):
-    styleid = 'Danmaku2ASS_%04x' % random.randint(0, 0xffff)
-    WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid)
-    rows = [[None] * (height - bottomReserved + 1) for i in range(4)]
-    for idx, i in enumerate(comments):
-        if progress_callback and idx % 1000 == 0:
-            progress_callback(idx, len(comments))
-        if isinstance(i[4], int):
-            skip = False
-            for filter_regex in filters_regex:
-                if filter_regex and filter_regex.search(i[3]):
-                    skip = True
-                    break
-            if skip:
+    return (trX, trY, WrapFlashAngle(outX), WrapFlashAngle(outY), WrapFlashAngle(outZ), scaleXY * 100, scaleXY * 100)
+
+
+@functools.lru_cache(maxsize=4096)
+def FlashRotationAngles(rotY, rotZ):
+    # The part of ConvertFlashRotation that does not depend on the position
+    # Result: (sinY, cosY, sinZ, cosZ, rotX, rotY, rotZ)
+    rotY = WrapFlashAngle(rotY)
+    rotZ = WrapFlashAngle(rotZ)
+    if rotY in (90, -90):
+        rotY -= 1
+    sinY, cosY = SinCosDegrees(rotY)
+    sinZ, cosZ = SinCosDegrees(rotZ)
+    if rotY == 0 or rotZ == 0:
+        outX = 0
+        outY = -rotY  # Positive value means clockwise in Flash
+        outZ = -rotZ
+    else:
+        outY = math.atan2(-sinY * cosZ, cosY) * 180 / math.pi
+        outZ = math.atan2(-cosY * sinZ, cosZ) * 180 / math.pi
+        outX = math.asin(sinY * sinZ) * 180 / math.pi
+    return (sinY, cosY, sinZ, cosZ, outX, outY, outZ)
+
+
+def WrapFlashAngle(deg):
+    return 180 - ((180 - deg) % 360)
+
+
+def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, filters_regex, reduced, progress_callback, stats=None):
+    ProcessCommentsForStages(comments, [(width, height, f)], bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, filters_regex, reduced, progress_callback, stats)
+
+
+def ProcessCommentsForStages(comments, targets, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, filters_regex, reduced, progress_callback, stats=None, styleid=None, window=None, jobs=1):
+    # Lay out the comments on several stages in a single pass
+    # targets is a list of (width, height, f)
+    # Each stage gets a random style id unless styleid is given
+    # window and jobs are as for LayoutComments
+    import random
+    if not isinstance(filters_regex, CommentFilter):
+        filters_regex = CommentFilter(filters_regex)
+    search_filters = filters_regex.search
+    if stats is not None and stats.detailed:
+        search_filters = stats.Timed('filter', search_filters)
+    stages = []
+    for width, height, f in targets:
+        if stats is not None and stats.detailed:
+            f = TimedWriter(f, stats)
+        stage = Stage(BufferedWriter(f), width, height, bottomReserved, styleid or 'Danmaku2ASS_%04x' % random.randint(0, 0xffff))
+        WriteASSHead(stage.f, width, height, fontface, fontsize, alpha, stage.styleid)
+        stages.append(stage)
+    LayoutComments(comments, stages, fontsize, duration_marquee, duration_still, search_filters, reduced, progress_callback, stats, window, jobs)
+    for stage in stages:
+        stage.f.flush()
+
+
+class Stage(object):
+    # The output and the occupied rows of one stage size
+
+    def __init__(self, f, width, height, bottomReserved, styleid):
+        self.f = f
+        self.width = width
+        self.height = height
+        self.bottomReserved = bottomReserved
+        self.styleid = styleid
+        self.rows = [CommentRows(height - bottomReserved + 1) for i in range(4)]
+
+
+LayoutBlockSize = 4096
+
+
+def IterColumnBlocks(comments, size):
+    # Yield the comments in blocks of the given size, each block as a tuple
+    # of columns.  A CommentTable is sliced column by column.
+    if isinstance(comments, CommentTable):
+        columns = [getattr(comments, name) for name in CommentTable.__slots__]
+        for start in range(0, len(comments), size):
+            yield tuple(column[start:start + size] for column in columns)
+        return
+    iterator = iter(comments)
+    while True:
+        block = list(itertools.islice(iterator, size))
+        if not block:
+            return
+        yield tuple(zip(*block))
+
+
+def SliceTimeline(comments, start=None, end=None):
+    # Return the sorted comments with start <= timeline < end.  A
+    # CommentTable is searched by bisection on its timeline and sliced, other
+    # comments, e.g. sorted on disk, are streamed up to end.
+    if not isinstance(comments, CommentTable):
+        comments = (c for c in comments if start is None or c[0] >= start)
+        return itertools.takewhile(lambda c: end is None or c[0] < end, comments)
+    lo = 0 if start is None else bisect.bisect_left(comments.timeline, start)
+    hi = len(comments) if end is None else bisect.bisect_left(comments.timeline, end)
+    return comments.Slice(lo, max(lo, hi))
+
+
+def LayoutComments(comments, stages, fontsize, duration_marquee, duration_still, search_filters, reduced, progress_callback=None, stats=None, window=None, jobs=1):
+    # If window is (start, offset), comments before start only take their
+    # rows, to warm up the stages, and the others are written offset
+    # seconds earlier.  Only written comments are counted.
+    # The rows of a comment depend on every comment before it, so they are
+    # always found here in order.  With more than one job, each block of
+    # comments is then formatted by FormatCommentBlock in a worker process
+    # while the next blocks are laid out, and written here in order.
+    # Progress is only reported as it goes for comments with a length.
+    filtered = positioned = 0
+    # Placements are counted for each stage
+    placed = [0] * len(stages)
+    overflow = [0] * len(stages)
+    dropped = [0] * len(stages)
+    widths = [stage.width for stage in stages]
+    start, offset = window if window is not None else (-math.inf, 0)
+    executor = pending = None
+    if jobs > 1:
+        import collections
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        pending = collections.deque()
+    specs = [(stage.width, stage.height, stage.bottomReserved, stage.styleid) for stage in stages]
+    total = len(comments) if hasattr(comments, '__len__') else None
+    idx = 0
+    try:
+        for columns in IterColumnBlocks(comments, LayoutBlockSize):
+            block = list(zip(*columns))
+            writes = []
+            numpy = GetNumPy(max(total or 0, idx + len(block)))
+            lengths, stage_times = PrecomputeLayout(columns[0], columns[4], columns[7], columns[8], widths, duration_marquee, duration_still, numpy)
+            for k, i in enumerate(block):
+                if progress_callback and total is not None and (idx + k) % 1000 == 0:
+                    progress_callback(idx + k, total)
+                if i[0] < start:
+                    if isinstance(i[4], int) and not search_filters(i[3]):
+                        for stage, (thresholds, releases) in zip(stages, stage_times):
+                            row = FindFreeRow(stage.rows, i, stage.height, stage.bottomReserved, lengths[k], thresholds[k])
+                            if row is None and not reduced:
+                                row = FindAlternativeRow(stage.rows, i, stage.height, stage.bottomReserved, lengths[k])
+                            if row is not None:
+                                MarkCommentRow(stage.rows, i, row, lengths[k], releases[k])
+                    continue
+                written = (i[0] - offset,) + i[1:] if offset else i
+                if isinstance(i[4], int):
+                    if search_filters(i[3]):
+                        filtered += 1
+                        continue
+                    length = lengths[k]
+                    for s, (stage, (thresholds, releases)) in enumerate(zip(stages, stage_times)):
+                        row = FindFreeRow(stage.rows, i, stage.height, stage.bottomReserved, length, thresholds[k])
+                        if row is not None:
+                            placed[s] += 1
+                        elif not reduced:
+                            row = FindAlternativeRow(stage.rows, i, stage.height, stage.bottomReserved, length)
+                            overflow[s] += 1
+                        else:
+                            dropped[s] += 1
+                        if row is not None:
+                            MarkCommentRow(stage.rows, i, row, length, releases[k])
+                            if pending is not None:
+                                writes.append((s, written, row))
+                            else:
+                                WriteComment(stage.f, written, row, stage.width, stage.height, stage.bottomReserved, fontsize, duration_marquee, duration_still, stage.styleid)
+                elif i[4] in ('bilipos', 'acfunpos'):
+                    if pending is not None:
+                        writes.append((None, written, None))
+                    elif i[4] == 'bilipos':
+                        for stage in stages:
+                            WriteCommentBilibiliPositioned(stage.f, written, stage.width, stage.height, stage.styleid)
+                    else:
+                        for stage in stages:
+                            WriteCommentAcfunPositioned(stage.f, written, stage.width, stage.height, stage.styleid)
+                    positioned += 1
+                else:
+                    ReportInvalidComment(_('Invalid comment: %r') % i[3])
+            idx += len(block)
+            if pending is not None:
+                pending.append(executor.submit(FormatCommentBlock, writes, specs, fontsize, duration_marquee, duration_still))
+                # Keep a few blocks queued per worker, not the whole output
+                while len(pending) > 2 * jobs or pending and pending[0].done():
+                    WriteFormattedBlock(stages, *pending.popleft().result())
+        while pending:
+            WriteFormattedBlock(stages, *pending.popleft().result())
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    if progress_callback:
+        progress_callback(idx, idx)
+    if stats is not None:
+        if not stats.targets:
+            stats.targets = [{'width': stage.width, 'height': stage.height, 'placed': 0, 'overflow': 0, 'reduced': 0} for stage in stages]
+        for target, counts in zip(stats.targets, zip(placed, overflow, dropped)):
+            for name, count in zip(('placed', 'overflow', 'reduced'), counts):
+                target[name] += count
+        if stages:
+            stats.placed += placed[0]
+            stats.overflow += overflow[0]
+            stats.reduced += dropped[0]
+        stats.filtered += filtered
+        stats.positioned += positioned
+
+
+def FormatCommentBlock(writes, stages, fontsize, duration_marquee, duration_still):
+    # Format the comments placed in a block by LayoutComments, in a worker
+    # process.  writes are (stage index, comment, row), the index being None
+    # for positioned comments written on every stage, and stages are
+    # (width, height, bottomReserved, styleid).  Return the text of each
+    # stage, what was logged meanwhile as (level, message) and the number of
+    # invalid comments.
+    outputs = [io.StringIO() for stage in stages]
+    invalid_count = InvalidComments.count
+    capture = LogCapture()
+    logger = logging.getLogger()
+    handlers, logger.handlers = logger.handlers, [capture]
+    try:
+        for s, c, row in writes:
+            if s is not None:
+                width, height, bottomReserved, styleid = stages[s]
+                WriteComment(outputs[s], c, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+                continue
+            WritePositioned = WriteCommentBilibiliPositioned if c[4] == 'bilipos' else WriteCommentAcfunPositioned
+            for f, (width, height, bottomReserved, styleid) in zip(outputs, stages):
+                WritePositioned(f, c, width, height, styleid)
+    finally:
+        logger.handlers = handlers
+    return [f.getvalue() for f in outputs], capture.records, InvalidComments.count - invalid_count
+
+
+def WriteFormattedBlock(stages, texts, records, invalid_count):
+    # Write what FormatCommentBlock returned and log its messages here, as
+    # if the block was formatted in this process
+    for level, message in records:
+        logging.log(level, message)
+    InvalidComments.count += invalid_count
+    for stage, text in zip(stages, texts):
+        stage.f.write(text)
+
+
+class LogCapture(logging.Handler):
+    # Keep the records logged, as (level, message)
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+class RepeatCollapser(object):
+    # Merge comments repeating the same text within window seconds of its
+    # first occurrence, such as a flood of "2333", into that first comment
+    # with the count appended.  Sorted comments go in and come out, held
+    # back for at most window seconds of timeline.  Call within
+    # UseWidthModel, as the widths of merged comments are estimated again.
+
+    CountFormat = '%s \u00d7%d'
+
+    def __init__(self, window):
+        self.window = window
+        self.merged = 0
+
+    def __call__(self, comments):
+        import collections
+        # [comment, count] in the order of the first comments, and the ones
+        # that can still take repeats by text
+        pending = collections.deque()
+        open_events = {}
+        for c in comments:
+            while pending and pending[0][0][0] + self.window < c[0]:
+                yield self.Flush(pending.popleft(), open_events)
+            if not isinstance(c[4], int):
+                pending.append([c, 1])
+                continue
+            event = open_events.get(c[3])
+            if event is not None:
+                event[1] += 1
+                self.merged += 1
                 continue
-            row = 0
-            rowmax = height - bottomReserved - i[7]
-            while row <= rowmax:
-                freerows = TestFreeRows(rows, i, row, width, height, bottomReserved, duration_marquee, duration_still)
-                if freerows >= i[7]:
-                    MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+            event = open_events[c[3]] = [c, 1]
+            pending.append(event)
+        while pending:
+            yield self.Flush(pending.popleft(), open_events)
+
+    def Flush(self, event, open_events):
+        c, count = event
+        if open_events.get(c[3]) is event:
+            del open_events[c[3]]
+        if count == 1:
+            return c
+        text = self.CountFormat % (c[3], count)
+        return c[:3] + (text,) + c[4:8] + (CalculateLength(text) * c[6],)
+
+
+def DropFilteredComments(comments, search_filters, start=-math.inf, stats=None):
+    # Drop the comments caught by the filters ahead of the layout, for the
+    # passes that need to see only the comments to be written.  As in
+    # LayoutComments, only the ones from start on are counted.
+    filtered = 0
+    try:
+        for c in comments:
+            if isinstance(c[4], int) and search_filters(c[3]):
+                if c[0] >= start:
+                    filtered += 1
+                continue
+            yield c
+    finally:
+        if stats is not None:
+            stats.filtered += filtered
+
+
+class DensitySampler(object):
+    # Thin out crowded parts of the timeline before layout, so that a spike
+    # of comments costs no more layout work than the stage can show.
+    # Sorted comments are taken one second of timeline at a time and kept in
+    # priority order: shorter texts first, then the earliest submitted, then
+    # the ones with a colour of their own.  Once max_per_second comments of a
+    # second are kept, the rest are dropped, and so is a comment whose type
+    # already has max_simultaneous kept comments on the stage.  Either limit
+    # may be None.  Positioned comments are always kept.
+    # Only the comments themselves decide, so every run keeps the same ones.
+
+    def __init__(self, max_per_second=None, max_simultaneous=None, duration_marquee=5.0, duration_still=5.0):
+        self.max_per_second = max_per_second
+        self.max_simultaneous = max_simultaneous
+        self.durations = (duration_marquee, duration_still, duration_still, duration_marquee)
+        self.dropped = 0
+
+    def __call__(self, comments):
+        # Yield the kept comments in their original order
+        import heapq
+        # End times of the kept comments on the stage, by type
+        visible = [[] for i in range(4)]
+        for second, group in itertools.groupby(comments, key=lambda c: math.floor(c[0])):
+            group = list(group)
+            for ends in visible:
+                while ends and ends[0] <= second:
+                    heapq.heappop(ends)
+            keep = [not isinstance(c[4], int) for c in group]
+            kept = 0
+            for k in sorted((k for k, c in enumerate(group) if not keep[k]), key=lambda k: self.Priority(group[k])):
+                if self.max_per_second is not None and kept >= self.max_per_second:
                     break
+                c = group[k]
+                ends = visible[c[4]]
+                if self.max_simultaneous is not None and len(ends) >= self.max_simultaneous:
+                    continue
+                # Counted as visible for the whole second, which is never
+                # less than the real number on the stage
+                heapq.heappush(ends, c[0] + self.durations[c[4]])
+                keep[k] = True
+                kept += 1
+            for c, is_kept in zip(group, keep):
+                if is_kept:
+                    yield c
                 else:
-                    row += freerows or 1
+                    self.dropped += 1
+
+    @staticmethod
+    def Priority(c):
+        # Timestamps that are not numbers, e.g. RFC3339 strings, only
+        # compare among themselves
+        return (len(c[3]), not isinstance(c[1], (int, float)), c[1], c[5] == 0xffffff, c[2])
+
+
+class CommentFilter(object):
+    # Test comments against many filter patterns at once.
+    # Patterns without any regular expression syntax are plain strings and
+    # are searched together with an Aho-Corasick automaton.  The remaining
+    # regular expressions are joined into a few large alternations.
+    # counts[k] is the number of comments caught by patterns[k].
+
+    RegexMetaChars = frozenset('.^$*+?{}[]\\|()')
+    AlternationSize = 100
+
+    def __init__(self, patterns):
+        self.patterns = []
+        literals = []
+        regexes = []
+        default_flags = re.compile('').flags
+        for pattern in patterns:
+            if not pattern:
+                continue
+            try:
+                regex = re.compile(pattern)
+            except:
+                raise ValueError(_('Invalid regular expression: %s') % pattern)
+            k = len(self.patterns)
+            self.patterns.append(pattern)
+            if isinstance(pattern, str) and not self.RegexMetaChars.intersection(pattern):
+                literals.append((k, pattern))
             else:
-                if not reduced:
-                    row = FindAlternativeRow(rows, i, height, bottomReserved)
-                    MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
-        elif i[4] == 'bilipos':
-            WriteCommentBilibiliPositioned(f, i, width, height, styleid)
-        elif i[4] == 'acfunpos':
-            WriteCommentAcfunPositioned(f, i, width, height, styleid)
-        else:
-            logging.warning(_('Invalid comment: %r') % i[3])
-    if progress_callback:
-        progress_callback(len(comments), len(comments))
-
-
-def TestFreeRows(rows, c, row, width, height, bottomReserved, duration_marquee, duration_still):
-    res = 0
-    rowmax = height - bottomReserved
-    targetRow = None
-    if c[4] in (1, 2):
-        while row < rowmax and res < c[7]:
-            if targetRow != rows[c[4]][row]:
-                targetRow = rows[c[4]][row]
-                if targetRow and targetRow[0] + duration_still > c[0]:
+                regexes.append((k, regex, regex.groups == 0 and regex.flags == default_flags))
+        self.counts = [0] * len(self.patterns)
+        self.BuildAutomaton(literals)
+        # A list of (regex, [(k, regex), ...]), the second item holds the
+        # patterns that were joined into the first one
+        self.alternations = []
+        mergeable = []
+        for k, regex, is_mergeable in regexes:
+            if is_mergeable:
+                mergeable.append((k, regex))
+            else:
+                self.alternations.append((regex, [(k, regex)]))
+        for i in range(0, len(mergeable), self.AlternationSize):
+            chunk = mergeable[i:i + self.AlternationSize]
+            if len(chunk) == 1:
+                self.alternations.append((chunk[0][1], chunk))
+                continue
+            try:
+                self.alternations.append((re.compile('|'.join('(?:%s)' % regex.pattern for k, regex in chunk)), chunk))
+            except re.error:
+                self.alternations.extend((regex, [(k, regex)]) for k, regex in chunk)
+
+    def Fork(self):
+        # A filter sharing the compiled patterns, with counts of its own
+        import copy
+        other = copy.copy(self)
+        other.counts = [0] * len(self.patterns)
+        return other
+
+    def BuildAutomaton(self, literals):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        for k, literal in literals:
+            state = 0
+            for char in literal:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.goto[state][char] = next_state
+                state = next_state
+            if self.output[state] is None:
+                self.output[state] = k
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                if state:
+                    self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+    def SearchLiterals(self, text):
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+    def search(self, text):
+        k = self.SearchLiterals(text) if len(self.goto) > 1 else None
+        if k is None:
+            for alternation, chunk in self.alternations:
+                if alternation.search(text):
+                    for k, regex in chunk:
+                        if regex.search(text):
+                            break
                     break
-            row += 1
-            res += 1
-    else:
-        try:
-            thresholdTime = c[0] - duration_marquee * (1 - width / (c[8] + width))
-        except ZeroDivisionError:
-            thresholdTime = c[0] - duration_marquee
-        while row < rowmax and res < c[7]:
-            if targetRow != rows[c[4]][row]:
-                targetRow = rows[c[4]][row]
-                try:
-                    if targetRow and (targetRow[0] > thresholdTime or targetRow[0] + targetRow[8] * duration_marquee / (targetRow[8] + width) > c[0]):
-                        break
-                except ZeroDivisionError:
-                    pass
-            row += 1
-            res += 1
-    return res
+            else:
+                return False
+        self.counts[k] += 1
+        return True
+
+
+class CommentRows(object):
+    # The rows of the stage occupied by one type of comments.
+    # Instead of one slot per pixel row, the occupied rows are kept as sorted
+    # and disjoint intervals [starts[k], ends[k]), each one remembering the
+    # comment placed there most recently and the time it releases the rows.
+
+    def __init__(self, size):
+        self.size = size
+        self.starts = []
+        self.ends = []
+        self.comments = []
+        self.releases = []
+
+
+def PrecomputeLayout(timelines, positions, heights, comment_widths, widths, duration_marquee, duration_still, numpy=None):
+    # Compute what the placement of a block of comments needs from each
+    # comment alone, given their columns, for stages of the given widths:
+    #     lengths:    The number of rows each comment covers
+    #     thresholds: A moving comment catches up with the comments on its
+    #                 rows that started after this time, inf for still ones
+    #     releases:   The time each comment leaves its rows free
+    # Return (lengths, [(thresholds, releases) for each width]), computed
+    # with the numpy module if one is given.
+    if numpy is None:
+        lengths = [math.ceil(h) for h in heights]
+        stage_times = []
+        for width in widths:
+            thresholds = []
+            releases = []
+            for t, p, w in zip(timelines, positions, comment_widths):
+                if p in (1, 2):
+                    thresholds.append(math.inf)
+                    releases.append(t + duration_still)
+                elif w + width != 0:
+                    thresholds.append(t - duration_marquee * (1 - width / (w + width)))
+                    releases.append(t + w * duration_marquee / (w + width))
+                else:
+                    thresholds.append(t - duration_marquee)
+                    releases.append(-math.inf)
+            stage_times.append((thresholds, releases))
+        return lengths, stage_times
+    timelines = numpy.asarray(timelines, dtype=float)
+    comment_widths = numpy.asarray(comment_widths, dtype=float)
+    positions = numpy.asarray(positions, dtype=object)
+    still = (positions == 1) | (positions == 2)
+    lengths = numpy.ceil(numpy.asarray(heights, dtype=float)).astype(numpy.int64).tolist()
+    stage_times = []
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        for width in widths:
+            total = comment_widths + width
+            moving = total != 0
+            thresholds = numpy.where(moving, timelines - duration_marquee * (1 - width / total), timelines - duration_marquee)
+            releases = numpy.where(moving, timelines + comment_widths * duration_marquee / total, -math.inf)
+            thresholds[still] = math.inf
+            releases[still] = timelines[still] + duration_still
+            stage_times.append((thresholds.tolist(), releases.tolist()))
+    return lengths, stage_times
+
+
+# NumPy takes about 50 ms to import, which its faster PrecomputeLayout only
+# pays back over this many comments
+NumPyMinComments = 131072
+
+
+def GetNumPy(count):
+    # Return the numpy module for laying out count comments, or None to use
+    # pure Python.  NumPy is optional, and only imported for conversions of
+    # at least NumPyMinComments comments unless it already was.
+    numpy = sys.modules.get('numpy')
+    if numpy is None and count >= NumPyMinComments:
+        numpy = ImportNumPy()
+    return numpy
+
+
+@functools.lru_cache(maxsize=None)
+def ImportNumPy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def FindFreeRow(rows, c, height, bottomReserved, length, thresholdTime):
+    rowmax = height - bottomReserved - c[7]
+    if rowmax < 0:
+        return None
+    lane = rows[c[4]]
+    row = 0
+    for start, end, comment, release in zip(lane.starts, lane.ends, lane.comments, lane.releases):
+        if start >= row + length:
+            break
+        if end <= row:
+            continue
+        if release > c[0] or comment[0] > thresholdTime:
+            row = end
+            if row > rowmax:
+                return None
+    return row
 
 
-def FindAlternativeRow(rows, c, height, bottomReserved):
+def FindAlternativeRow(rows, c, height, bottomReserved, length):
+    lane = rows[c[4]]
+    rowmax = height - bottomReserved - length
     res = 0
-    for row in range(height - bottomReserved - math.ceil(c[7])):
-        if not rows[c[4]][row]:
+    restime = None
+    row = 0
+    for start, end, comment in zip(lane.starts, lane.ends, lane.comments):
+        if row >= rowmax:
+            break
+        if start > row:
             return row
-        elif rows[c[4]][row][0] < rows[c[4]][res][0]:
+        if restime is None or comment[0] < restime:
             res = row
+            restime = comment[0]
+        row = end
+    if row < rowmax:
+        return row
     return res
 
 
-def MarkCommentRow(rows, c, row):
-    try:
-        for i in range(row, row + math.ceil(c[7])):
-            rows[c[4]][i] = c
-    except IndexError:
-        pass
+def MarkCommentRow(rows, c, row, length, release):
+    lane = rows[c[4]]
+    end = min(row + length, lane.size)
+    if row >= end:
+        return
+    lo = bisect.bisect_right(lane.ends, row)
+    hi = bisect.bisect_left(lane.starts, end)
+    starts, ends, comments, releases = [row], [end], [c], [release]
+    if lo < hi:
+        if lane.starts[lo] < row:
+            starts.insert(0, lane.starts[lo])
+            ends.insert(0, row)
+            comments.insert(0, lane.comments[lo])
+            releases.insert(0, lane.releases[lo])
+        if lane.ends[hi - 1] > end:
+            starts.append(end)
+            ends.append(lane.ends[hi - 1])
+            comments.append(lane.comments[hi - 1])
+            releases.append(lane.releases[hi - 1])
+    lane.starts[lo:hi] = starts
+    lane.ends[lo:hi] = ends
+    lane.comments[lo:hi] = comments
+    lane.releases[lo:hi] = releases
 
 
 def WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid):
@@ -771,28 +1535,38 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
 def WriteComment(f, c, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid):
     text = ASSEscape(c[3])
-    styles = []
     if c[4] == 1:
-        styles.append('\\an8\\pos(%(halfwidth)d, %(row)d)' % {'halfwidth': width / 2, 'row': row})
+        styles = '\\an8\\pos(%d, %d)' % (width / 2, row)
         duration = duration_still
     elif c[4] == 2:
-        styles.append('\\an2\\pos(%(halfwidth)d, %(row)d)' % {'halfwidth': width / 2, 'row': ConvertType2(row, height, bottomReserved)})
+        styles = '\\an2\\pos(%d, %d)' % (width / 2, ConvertType2(row, height, bottomReserved))
         duration = duration_still
     elif c[4] == 3:
-        styles.append('\\move(%(neglen)d, %(row)d, %(width)d, %(row)d)' % {'width': width, 'row': row, 'neglen': -math.ceil(c[8])})
+        styles = '\\move(%d, %d, %d, %d)' % (-math.ceil(c[8]), row, width, row)
         duration = duration_marquee
     else:
-        styles.append('\\move(%(width)d, %(row)d, %(neglen)d, %(row)d)' % {'width': width, 'row': row, 'neglen': -math.ceil(c[8])})
+        styles = '\\move(%d, %d, %d, %d)' % (width, row, -math.ceil(c[8]), row)
         duration = duration_marquee
-    if not (-1 < c[6] - fontsize < 1):
-        styles.append('\\fs%.0f' % c[6])
-    if c[5] != 0xffffff:
-        styles.append('\\c&H%s&' % ConvertColor(c[5]))
-        if c[5] == 0x000000:
-            styles.append('\\3c&HFFFFFF&')
-    f.write('Dialogue: 2,%(start)s,%(end)s,%(styleid)s,,0000,0000,0000,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(c[0]), 'end': ConvertTimestamp(c[0] + duration), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
+    f.write('Dialogue: 2,%s,%s,%s,,0000,0000,0000,,{%s%s%s}%s\n' % (ConvertTimestamp(c[0]), ConvertTimestamp(c[0] + duration), styleid, styles, GetFontSizeStyle(c[6], fontsize), GetColorStyle(c[5]), text))
+
+
+@functools.lru_cache(maxsize=1024)
+def GetFontSizeStyle(size, fontsize):
+    if -1 < size - fontsize < 1:
+        return ''
+    return '\\fs%.0f' % size
+
 
+@functools.lru_cache(maxsize=1024)
+def GetColorStyle(color):
+    if color == 0xffffff:
+        return ''
+    elif color == 0x000000:
+        return '\\c&H%s&\\3c&HFFFFFF&' % ConvertColor(color)
+    return '\\c&H%s&' % ConvertColor(color)
 
+
+@functools.lru_cache(maxsize=4096)
 def ASSEscape(s):
     def ReplaceLeadingSpace(s):
         if len(s) == 0:
@@ -806,7 +1580,113 @@ def ASSEscape(s):
 
 
 def CalculateLength(s):
-    return max(map(len, s.split('\n')))  # May not be accurate
+    # Width of the widest line in units of the font size, as estimated by
+    # the width model in use
+    return CurrentWidthModel.model(s)
+
+
+class CharacterCountWidthModel(object):
+    # Every character is as wide as the font size, which reserves about
+    # twice the real width for Latin text
+
+    key = 'length'
+
+    def __call__(self, s):
+        return max(map(len, s.split('\n')))
+
+
+class GlyphWidthModel(dict):
+    # Memoized advance of each character in units of the font size.
+    # Characters missing from the table get an advance from their East Asian
+    # Width class: wide and fullwidth ones count as one, and so do ambiguous
+    # symbols, which CJK fonts draw full width.  Combining marks and format
+    # characters count as zero, and the others, accented letters included,
+    # as a half.
+
+    def __init__(self, advances=(), key='eastasian'):
+        super().__init__(advances)
+        self.key = key
+        # Text of ASCII characters that keep their default advance of a half
+        # is measured with len()
+        self.ascii_fast = not any(ord(c) < 0x80 for c in self)
+
+    def __missing__(self, c):
+        if unicodedata.category(c) in ('Mn', 'Me', 'Cf'):
+            advance = 0.0
+        elif unicodedata.east_asian_width(c) in ('W', 'F') or (unicodedata.east_asian_width(c) == 'A' and not unicodedata.category(c).startswith('L')):
+            advance = 1.0
+        else:
+            advance = 0.5
+        self[c] = advance
+        return advance
+
+    def __call__(self, s):
+        if self.ascii_fast and s.isascii():
+            return max(map(len, s.split('\n'))) * 0.5
+        getitem = self.__getitem__
+        return max(sum(map(getitem, line)) for line in s.split('\n'))
+
+
+def LoadFontWidthModel(font_file, cache_dir=None, cache_size=None):
+    # Read the advance widths of a TrueType or OpenType font.  The font is
+    # slow to parse, so the table is kept in the comment cache if cache_dir
+    # is given.
+    import hashlib
+    digest = hashlib.sha256()
+    with open(font_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1048576), b''):
+            digest.update(chunk)
+    key = 'font-' + digest.hexdigest()
+    cache = CommentCache(cache_dir, cache_size) if cache_dir else None
+    advances = cache.Load(key) if cache else None
+    if advances is None:
+        try:
+            import fontTools.ttLib
+        except ImportError:
+            raise ImportError(_('Reading font metrics requires fontTools'))
+        font = fontTools.ttLib.TTFont(font_file, fontNumber=0, lazy=True)
+        units_per_em = font['head'].unitsPerEm
+        hmtx = font['hmtx']
+        advances = {chr(codepoint): hmtx[glyph][0] / units_per_em for codepoint, glyph in font.getBestCmap().items()}
+        font.close()
+        if cache:
+            cache.Store(key, advances)
+    return GlyphWidthModel(advances, key)
+
+
+def GetWidthModel(width_model='eastasian', font_file=None, cache_dir=None, cache_size=None):
+    if font_file:
+        return LoadFontWidthModel(font_file, cache_dir, cache_size)
+    if width_model == 'eastasian':
+        return GlyphWidthModel()
+    if width_model == 'length':
+        return CharacterCountWidthModel()
+    if callable(width_model):
+        return width_model
+    raise ValueError(_('Unknown width model: %r') % width_model)
+
+
+@contextlib.contextmanager
+def UseWidthModel(width_model):
+    # Only for the current thread, conversions in other threads may use
+    # other width models at the same time
+    previous = CurrentWidthModel.model
+    if width_model is not None:
+        CurrentWidthModel.model = width_model
+    try:
+        yield CurrentWidthModel.model
+    finally:
+        CurrentWidthModel.model = previous
+
+
+class ThreadWidthModel(threading.local):
+    # The width model used by CalculateLength in each thread, the class
+    # attribute being the default of every thread
+
+    model = GlyphWidthModel()
+
+
+CurrentWidthModel = ThreadWidthModel()
 
 
 def ConvertTimestamp(timestamp):
@@ -817,6 +1697,7 @@ def ConvertTimestamp(timestamp):
     return '%d:%02d:%02d.%02d' % (int(hour), int(minute), int(second), int(centsecond))
 
 
+@functools.lru_cache(maxsize=1024)
 def ConvertColor(RGB, width=1280, height=576):
     if RGB == 0x000000:
         return '000000'
@@ -849,10 +1730,429 @@ def ConvertToFile(filename_or_file, *args, **kwargs):
         return filename_or_file
 
 
-def FilterBadChars(f):
-    s = f.read()
-    s = re.sub('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]', '\ufffd', s)
-    return io.StringIO(s)
+@contextlib.contextmanager
+def OpenCommentFile(filename_or_file):
+    # Yield a text file positioned at the start of the comments, and its
+    # first characters to probe the format with.  Compressed files are
+    # decompressed on the fly as they are read.
+    with contextlib.ExitStack() as stack:
+        f = stack.enter_context(ConvertToFile(filename_or_file, 'rb'))
+        if isinstance(f.read(0), str):
+            if not f.seekable():
+                f = io.StringIO(f.read())
+            head = f.read(ProbeSize)
+            f.seek(0)
+            yield f, head
+            return
+        if not hasattr(f, 'peek'):
+            f = io.BufferedReader(f)
+        f = stack.enter_context(DecompressStream(f))
+        head = f.peek(ProbeSize)[:ProbeSize].decode('utf-8', 'replace')
+        yield stack.enter_context(io.TextIOWrapper(f, encoding='utf-8', errors='replace')), head
+
+
+ProbeSize = 64
+
+
+def DecompressStream(f):
+    # Guess the compression of the buffered binary stream f from its first
+    # bytes and return a buffered stream of the decompressed data
+    magic = f.peek(ProbeSize)[:ProbeSize]
+    if magic.startswith(ArchiveMagic):
+        return f
+    if magic.startswith(b'\x1f\x8b'):
+        import gzip
+        return io.BufferedReader(gzip.GzipFile(fileobj=f, mode='rb'))
+    if magic.startswith(b'BZh'):
+        import bz2
+        return io.BufferedReader(bz2.BZ2File(f, 'rb'))
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        import lzma
+        return io.BufferedReader(lzma.LZMAFile(f, 'rb'))
+    if len(magic) >= 2 and magic[0] & 0x0f == 8 and magic[0] >> 4 <= 7 and (magic[0] << 8 | magic[1]) % 31 == 0:
+        return io.BufferedReader(InflateReader(f, zlib.MAX_WBITS))
+    if magic and magic[:1] not in b'<[{\xef \t\r\n':
+        # Raw deflate has no magic number, see if the buffered bytes inflate
+        # and, when they are all there is, end the stream
+        data = f.peek(ProbeSize)
+        try:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            decompressor.decompress(data)
+            if decompressor.eof or len(data) >= ProbeSize:
+                return io.BufferedReader(InflateReader(f, -zlib.MAX_WBITS))
+        except zlib.error:
+            pass
+    return f
+
+
+class InflateReader(io.RawIOBase):
+    # Inflate a zlib or raw deflate stream as it is read
+
+    def __init__(self, f, wbits):
+        self.f = f
+        self.decompressor = zlib.decompressobj(wbits)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.f.read(65536)
+                if not data:
+                    raise EOFError(_('Compressed file ended before the end-of-stream marker was reached'))
+            data = self.decompressor.decompress(data, len(b))
+            if data:
+                b[:len(data)] = data
+                return len(data)
+        return 0
+
+
+class FilterBadChars(object):
+    # Replace control characters that XML and JSON parsers choke on,
+    # one chunk at a time as the parser reads the file
+
+    BadChars = re.compile('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]')
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        return self.BadChars.sub('\ufffd', self.f.read(size))
+
+
+class CommentTable(object):
+    # Comments stored column by column instead of as a list of 9-tuples.
+    # Numbers go into typed arrays and texts are interned, which takes a
+    # fraction of the memory.  Iterating or indexing a table still gives the
+    # tuples of the ReadComments**** protocol.
+
+    __slots__ = ('timeline', 'timestamp', 'no', 'comment', 'pos', 'color', 'size', 'height', 'width')
+    TypeCodes = ('d', 'q', 'q', None, None, 'q', 'd', 'd', 'd')
+
+    def __init__(self, comments=()):
+        for name, typecode in zip(self.__slots__, self.TypeCodes):
+            setattr(self, name, array.array(typecode) if typecode else [])
+        self.extend(comments)
+
+    def append(self, c):
+        if isinstance(c[3], str):
+            c = c[:3] + (sys.intern(c[3]),) + c[4:]
+        for name, value in zip(self.__slots__, c):
+            column = getattr(self, name)
+            try:
+                column.append(value)
+            except (TypeError, OverflowError):
+                # Not representable in the typed array, e.g. an RFC3339
+                # timestamp, fall back to a plain list for this column
+                column = list(column)
+                column.append(value)
+                setattr(self, name, column)
+
+    def extend(self, comments):
+        for c in comments:
+            self.append(c)
+
+    def sort(self):
+        # Stable sorts from the least significant key, equivalent to
+        # sorting by (timeline, timestamp, no) and keeping the input order
+        # of comments that are still equal
+        order = range(len(self))
+        for name in ('no', 'timestamp', 'timeline'):
+            order = sorted(order, key=getattr(self, name).__getitem__)
+        for name in self.__slots__:
+            column = getattr(self, name)
+            if isinstance(column, array.array):
+                setattr(self, name, array.array(column.typecode, map(column.__getitem__, order)))
+            else:
+                setattr(self, name, list(map(column.__getitem__, order)))
+
+    def __len__(self):
+        return len(self.timeline)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # A list of tuples, as slicing a list of comments gives
+            return list(zip(*(getattr(self, name)[index] for name in self.__slots__)))
+        return tuple(getattr(self, name)[index] for name in self.__slots__)
+
+    def __iter__(self):
+        return zip(*(getattr(self, name) for name in self.__slots__))
+
+    def Slice(self, start, stop):
+        # Return the comments from index start to stop as another table
+        return self.FromColumns([getattr(self, name)[start:stop] for name in self.__slots__])
+
+    @classmethod
+    def FromColumns(cls, columns):
+        # Wrap existing columns, in the order of __slots__, without copying
+        table = cls.__new__(cls)
+        for name, column in zip(cls.__slots__, columns):
+            setattr(table, name, column)
+        return table
+
+
+class CommentCache(object):
+    # Sorted comments of earlier runs, stored in a directory shared by any
+    # number of processes.  Entries are keyed by the contents of the input
+    # files, the format, the font size, the width model and whether
+    # duplicates were dropped.  They are written to a temporary
+    # file and renamed into place, so readers never see a partial entry.
+    # Once the directory is over size_limit bytes, the least recently used
+    # entries are removed.
+
+    Version = 6
+
+    def __init__(self, directory, size_limit=None):
+        self.directory = directory
+        self.size_limit = size_limit
+        os.makedirs(directory, exist_ok=True)
+
+    def Key(self, input_files, input_format, font_size, width_model_key='', dedupe=False):
+        import hashlib
+        key = hashlib.sha256(('%d\n%s\n%r\n%s\n%s' % (self.Version, input_format, font_size, width_model_key, 'dedupe\n' if dedupe else '')).encode('utf-8'))
+        for filename in input_files:
+            content = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    content.update(chunk)
+            key.update(content.digest())
+        return key.hexdigest()
+
+    def Load(self, key):
+        import pickle
+        path = os.path.join(self.directory, key + '.pickle')
+        try:
+            with open(path, 'rb') as f:
+                res = pickle.load(f)
+            os.utime(path)
+            return res
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(_('Ignoring broken cache entry %s: %s') % (path, e))
+            self.Remove(path)
+            return None
+
+    def Store(self, key, value):
+        import pickle
+        import tempfile
+        try:
+            with tempfile.NamedTemporaryFile('wb', dir=self.directory, suffix='.tmp', delete=False) as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(f.name, os.path.join(self.directory, key + '.pickle'))
+        except OSError as e:
+            logging.warning(_('Failed to write cache entry: %s') % e)
+            return
+        if self.size_limit is not None:
+            self.Evict()
+
+    def Evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.size_limit:
+                break
+            self.Remove(os.path.join(self.directory, name))
+            total -= size
+
+    @staticmethod
+    def Remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class ConversionStats(object):
+    # Counters and timings of a conversion, returned by Danmaku2ASS
+    #
+    # phases:         {phase: {'wall': seconds, 'cpu': seconds}}
+    #                 read, sort and process are always timed, process is
+    #                 split into filter, layout and write if detailed is set,
+    #                 sample is timed if the RepeatCollapser or the
+    #                 DensitySampler is used
+    # comments_read:  {format: number of comments read}
+    # filtered:       Comments caught by the filters
+    # filter_counts:  [{'pattern': pattern, 'count': comments caught}, ...]
+    # cache_hit:      Whether comments came from the cache, None if not used
+    # placed:         Comments placed on a free row
+    # overflow:       Comments placed over other ones as the stage was full
+    # reduced:        Comments dropped as the stage was full
+    #                 These three are for the first target, each comment
+    #                 being counted once
+    # targets:        [{'width': width, 'height': height, 'placed': count,
+    #                   'overflow': count, 'reduced': count}, ...], the
+    #                 counts above for each target
+    # sampled:        Comments dropped by the DensitySampler before layout
+    # duplicates:     Comments dropped by the DuplicateFilter
+    # collapsed:      Comments merged into another one by the RepeatCollapser
+    # positioned:     Positioned comments
+    # invalid:        Invalid comments, see ReportInvalidComment
+    # peak_memory:    Peak resident memory of the process in bytes, or None
+
+    def __init__(self, detailed=False):
+        self.detailed = detailed
+        self.phases = {}
+        self.comments_read = {}
+        self.cache_hit = None
+        self.filtered = 0
+        self.filter_counts = []
+        self.placed = 0
+        self.overflow = 0
+        self.reduced = 0
+        self.targets = []
+        self.sampled = 0
+        self.duplicates = 0
+        self.collapsed = 0
+        self.positioned = 0
+        self.invalid = 0
+        self.peak_memory = None
+
+    def AddTime(self, phase, wall_time, cpu_time):
+        total = self.phases.setdefault(phase, {'wall': 0.0, 'cpu': 0.0})
+        total['wall'] += wall_time
+        total['cpu'] += cpu_time
+
+    @contextlib.contextmanager
+    def Timer(self, phase):
+        wall_time, cpu_time = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            self.AddTime(phase, time.perf_counter() - wall_time, time.process_time() - cpu_time)
+
+    def Timed(self, phase, function):
+        def timed_function(*args, **kwargs):
+            wall_time, cpu_time = time.perf_counter(), time.process_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.AddTime(phase, time.perf_counter() - wall_time, time.process_time() - cpu_time)
+        return timed_function
+
+
+class BufferedWriter(object):
+    # Collect the written lines and pass them to f in large chunks, which
+    # saves most of the per-call cost of encoding and newline translation
+
+    ChunkLines = 1024
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = []
+
+    def write(self, s):
+        self.buffer.append(s)
+        if len(self.buffer) >= self.ChunkLines:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.f.write(''.join(self.buffer))
+            self.buffer = []
+
+
+class TimedWriter(object):
+
+    def __init__(self, f, stats):
+        self.write = stats.Timed('write', f.write)
+
+
+def ReportInvalidComment(message):
+    # Log an invalid comment as a warning and count it for the conversion
+    # running in this thread, whatever the logging configuration is
+    InvalidComments.count += 1
+    logging.warning(message)
+
+
+class InvalidCommentCount(threading.local):
+    # The invalid comments reported in each thread so far
+
+    count = 0
+
+
+InvalidComments = InvalidCommentCount()
+
+
+def GetPeakMemory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak
+    else:
+        return peak * 1024
+
+
+def CommentSortKey(c):
+    return (c[0], c[1], c[2])
+
+
+class ExternalCommentSorter(object):
+    # Sort comments with a bounded amount of memory.
+    # Comments are buffered until their estimated size exceeds memory_limit
+    # bytes, then the buffer is sorted and spilled to a temporary file.
+    # Iterating merges all the sorted runs together.
+
+    RunBatchSize = 256
+
+    def __init__(self, memory_limit):
+        self.memory_limit = memory_limit
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+        self.count = 0
+
+    def extend(self, comments):
+        for c in comments:
+            self.buffer.append(c)
+            self.buffer_size += sys.getsizeof(c[3]) + 256  # plus a rough cost of the tuple and its numbers
+            self.count += 1
+            if self.buffer_size > self.memory_limit:
+                self.spill()
+
+    def spill(self):
+        import pickle
+        import tempfile
+        self.buffer.sort(key=CommentSortKey)
+        run = tempfile.TemporaryFile()
+        for i in range(0, len(self.buffer), self.RunBatchSize):
+            pickle.dump(self.buffer[i:i + self.RunBatchSize], run, pickle.HIGHEST_PROTOCOL)
+        self.runs.append(run)
+        self.buffer = []
+        self.buffer_size = 0
+
+    def sort(self):
+        self.buffer.sort(key=CommentSortKey)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        import heapq
+        return heapq.merge(*[self.ReadRun(run) for run in self.runs] + [self.buffer], key=CommentSortKey)
+
+    @staticmethod
+    def ReadRun(run):
+        import pickle
+        run.seek(0)
+        while True:
+            try:
+                batch = pickle.load(run)
+            except EOFError:
+                return
+            yield from batch
 
 
 class safe_list(list):
@@ -874,63 +2174,843 @@ def export(func):
 
 
 @export
-def Danmaku2ASS(input_files, input_format, output_file, stage_width, stage_height, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, progress_callback=None):
-    comment_filters = [comment_filter]
+class Converter(object):
+    # The settings of a conversion, taking the same arguments as Danmaku2ASS.
+    # Filters are compiled and the width model is loaded once, then each
+    # Convert call keeps its state to itself: the width model is only set
+    # for the calling thread and filter counts are kept per call.  A
+    # Converter can thus be used by many threads at once, and so can many
+    # Converters.  Outputs get a random style id unless styleid is given.
+    # If start or end is given, only comments from start to end are written,
+    # at their own times or, with rebase, at times counted from start.
+    # Comments of the warmup seconds before start are laid out unwritten, so
+    # that the rows taken at start are mostly as in a full conversion; only
+    # an infinite warmup reproduces it exactly on a busy stage.  With jobs
+    # above 1, output lines are formatted in that many worker processes.
+
+    def __init__(self, reserve_blank=0, font_face=None, font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, memory_limit=None, detailed_stats=False, cache_dir=None, cache_size=1073741824, width_model='eastasian', font_file=None, max_per_second=None, max_simultaneous=None, dedupe=False, collapse_window=None, start=None, end=None, rebase=False, warmup=None, jobs=1, styleid=None):
+        comment_filters = list(comment_filter) if isinstance(comment_filter, (list, tuple)) else [comment_filter]
+        if comment_filters_file:
+            with open(comment_filters_file, 'r') as f:
+                d = f.readlines()
+                comment_filters.extend([i.strip() for i in d])
+        self.filters_regex = CommentFilter(comment_filters)
+        self.reserve_blank = reserve_blank
+        self.font_face = font_face if font_face is not None else DefaultFontFace()
+        self.font_size = font_size
+        self.text_opacity = text_opacity
+        self.duration_marquee = duration_marquee
+        self.duration_still = duration_still
+        self.is_reduce_comments = is_reduce_comments
+        self.memory_limit = memory_limit
+        self.detailed_stats = detailed_stats
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.width_model = GetWidthModel(width_model, font_file, cache_dir, cache_size)
+        self.max_per_second = max_per_second
+        self.max_simultaneous = max_simultaneous
+        self.dedupe = dedupe
+        self.collapse_window = collapse_window
+        self.start = start
+        self.end = end
+        self.rebase = rebase
+        self.warmup = warmup if warmup is not None else 2 * max(duration_marquee, duration_still)
+        self.jobs = jobs
+        self.styleid = styleid
+
+    def Convert(self, input_files, input_format, targets, progress_callback=None):
+        # Read and filter the comments once, then write one output per target
+        # targets is a list of (stage_width, stage_height, output_file)
+        filters_regex = self.filters_regex.Fork()
+        stats = ConversionStats(self.detailed_stats)
+        invalid_count = InvalidComments.count
+        try:
+            opened = []
+            comments = ReadComments(input_files, input_format, self.font_size, memory_limit=self.memory_limit, stats=stats, cache_dir=self.cache_dir, cache_size=self.cache_size, width_model=self.width_model, dedupe=self.dedupe)
+            window = None
+            if self.start is not None or self.end is not None:
+                # Lay out from a warm-up period before the window, so that
+                # the rows are taken as in a full conversion at its start
+                warmup_start = None
+                if self.start is not None:
+                    warmup_start = self.start - self.warmup
+                    window = (self.start, self.start if self.rebase else 0)
+                comments = SliceTimeline(comments, warmup_start, self.end)
+            collapser = RepeatCollapser(self.collapse_window) if self.collapse_window else None
+            sampler = DensitySampler(self.max_per_second, self.max_simultaneous, self.duration_marquee, self.duration_still) if self.max_per_second is not None or self.max_simultaneous is not None else None
+            if collapser is not None or sampler is not None:
+                # All run in the same pass over the sorted comments.  The
+                # filters go first, so that comments they drop are neither
+                # counted as repeats nor kept instead of others.
+                search_filters = filters_regex.search
+                if stats.detailed:
+                    search_filters = stats.Timed('filter', search_filters)
+                comments = DropFilteredComments(comments, search_filters, window[0] if window is not None else -math.inf, stats)
+                if collapser is not None:
+                    comments = collapser(comments)
+                if sampler is not None:
+                    comments = sampler(comments)
+                if not self.memory_limit:
+                    with stats.Timer('sample'), UseWidthModel(self.width_model):
+                        comments = CommentTable(comments)
+            try:
+                stage_targets = []
+                for stage_width, stage_height, output_file in targets:
+                    if output_file:
+                        fo = ConvertToFile(output_file, 'w', encoding='utf-8-sig', errors='replace', newline='\r\n')
+                        if fo != output_file:
+                            opened.append(fo)
+                    else:
+                        fo = sys.stdout
+                    stage_targets.append((stage_width, stage_height, fo))
+                # Layout is what process took besides the filtering and
+                # writing done meanwhile, the filters may also have run
+                # before, along with the sampler
+                nested = {phase: dict(stats.phases.get(phase, {'wall': 0.0, 'cpu': 0.0})) for phase in ('filter', 'write')}
+                # With a memory limit, comments are collapsed and sampled
+                # while they are laid out
+                with stats.Timer('process'), UseWidthModel(self.width_model):
+                    ProcessCommentsForStages(comments, stage_targets, self.reserve_blank, self.font_face, self.font_size, self.text_opacity, self.duration_marquee, self.duration_still, filters_regex, self.is_reduce_comments, progress_callback, stats, self.styleid, window, self.jobs)
+                stats.collapsed = collapser.merged if collapser is not None else 0
+                stats.sampled = sampler.dropped if sampler is not None else 0
+            finally:
+                if self.detailed_stats and 'process' in stats.phases:
+                    stats.AddTime('layout', *(stats.phases['process'][i] - sum(stats.phases.get(phase, {i: 0.0})[i] - nested[phase][i] for phase in nested) for i in ('wall', 'cpu')))
+                with stats.Timer('write' if self.detailed_stats else 'process'):
+                    for fo in opened:
+                        fo.close()
+        finally:
+            stats.invalid = InvalidComments.count - invalid_count
+        for pattern, count in zip(filters_regex.patterns, filters_regex.counts):
+            logging.info(_('Filter %r caught %d comments') % (pattern, count))
+            stats.filter_counts.append({'pattern': str(pattern), 'count': count})
+        stats.peak_memory = GetPeakMemory()
+        return stats
+
+
+@export
+def Danmaku2ASS(input_files, input_format, output_file, stage_width, stage_height, reserve_blank=0, font_face=None, font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, progress_callback=None, memory_limit=None, detailed_stats=False, cache_dir=None, cache_size=1073741824, width_model='eastasian', font_file=None, max_per_second=None, max_simultaneous=None, dedupe=False, collapse_window=None, start=None, end=None, rebase=False, warmup=None, jobs=1):
+    return Converter(reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, comment_filter, comment_filters_file, is_reduce_comments, memory_limit, detailed_stats, cache_dir, cache_size, width_model, font_file, max_per_second, max_simultaneous, dedupe, collapse_window, start, end, rebase, warmup, jobs).Convert(input_files, input_format, [(stage_width, stage_height, output_file)], progress_callback)
+
+
+@export
+def Danmaku2ASSMultiStage(input_files, input_format, targets, reserve_blank=0, font_face=None, font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, progress_callback=None, memory_limit=None, detailed_stats=False, cache_dir=None, cache_size=1073741824, width_model='eastasian', font_file=None, max_per_second=None, max_simultaneous=None, dedupe=False, collapse_window=None, start=None, end=None, rebase=False, warmup=None, jobs=1):
+    # targets is a list of (stage_width, stage_height, output_file)
+    return Converter(reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, comment_filter, comment_filters_file, is_reduce_comments, memory_limit, detailed_stats, cache_dir, cache_size, width_model, font_file, max_per_second, max_simultaneous, dedupe, collapse_window, start, end, rebase, warmup, jobs).Convert(input_files, input_format, targets, progress_callback)
+
+
+@export
+class IncrementalConverter(object):
+    # Convert comments that keep arriving, e.g. from a live stream.
+    # The rows occupied on the stage are kept between calls, so Convert only
+    # costs as much as the comments passed to it and returns the Dialogue
+    # lines for those comments only.  Header returns the ASS header to put
+    # before them.  Checkpoint saves the whole state as bytes for Restore.
+
+    def __init__(self, stage_width, stage_height, reserve_blank=0, font_face=None, font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False):
+        import random
+        comment_filters = [comment_filter]
+        if comment_filters_file:
+            with open(comment_filters_file, 'r') as f:
+                d = f.readlines()
+                comment_filters.extend([i.strip() for i in d])
+        self.filters_regex = CommentFilter(comment_filters)
+        self.stage_width = stage_width
+        self.stage_height = stage_height
+        self.reserve_blank = reserve_blank
+        self.font_face = font_face if font_face is not None else DefaultFontFace()
+        self.font_size = font_size
+        self.text_opacity = text_opacity
+        self.duration_marquee = duration_marquee
+        self.duration_still = duration_still
+        self.is_reduce_comments = is_reduce_comments
+        self.stage = Stage(None, stage_width, stage_height, reserve_blank, 'Danmaku2ASS_%04x' % random.randint(0, 0xffff))
+        self.stats = ConversionStats()
+
+    def Header(self):
+        f = io.StringIO()
+        WriteASSHead(f, self.stage_width, self.stage_height, self.font_face, self.font_size, self.text_opacity, self.stage.styleid)
+        return f.getvalue()
+
+    def Convert(self, comments):
+        # comments are ReadComments**** tuples that come after the ones of
+        # the previous calls on the timeline
+        comments = sorted(comments, key=CommentSortKey)
+        self.stage.f = io.StringIO()
+        try:
+            LayoutComments(comments, [self.stage], self.font_size, self.duration_marquee, self.duration_still, self.filters_regex.search, self.is_reduce_comments, stats=self.stats)
+            return self.stage.f.getvalue()
+        finally:
+            self.stage.f = None
+
+    def Checkpoint(self):
+        import pickle
+        return pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def Restore(checkpoint):
+        # Only restore checkpoints from a trusted source, as with any pickle
+        import pickle
+        converter = pickle.loads(checkpoint)
+        if not isinstance(converter, IncrementalConverter):
+            raise ValueError(_('Invalid checkpoint'))
+        return converter
+
+
+@export
+def Danmaku2ASSBatch(input_output_files, stage_width, stage_height, jobs=None, input_format='autodetect', skip_up_to_date=True, **kwargs):
+    # Convert many (input_file, output_file) pairs, each into its own output
+    # Yield (input_file, output_file, error) as soon as each conversion ends,
+    # error being None on success; one failing file does not stop the others
+    import concurrent.futures
+    tasks = []
+    for input_file, output_file in input_output_files:
+        if skip_up_to_date and IsOutputUpToDate(input_file, output_file):
+            continue
+        tasks.append((input_file, output_file))
+    if jobs == 1:
+        for input_file, output_file in tasks:
+            try:
+                ConvertBatchFile(input_file, input_format, output_file, stage_width, stage_height, kwargs)
+            except Exception as e:
+                yield input_file, output_file, e
+            else:
+                yield input_file, output_file, None
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(ConvertBatchFile, input_file, input_format, output_file, stage_width, stage_height, kwargs): (input_file, output_file) for input_file, output_file in tasks}
+        for future in concurrent.futures.as_completed(futures):
+            input_file, output_file = futures[future]
+            yield input_file, output_file, future.exception()
+
+
+def ConvertBatchFile(input_file, input_format, output_file, stage_width, stage_height, kwargs):
+    try:
+        Danmaku2ASS(input_file, input_format, output_file, stage_width, stage_height, **kwargs)
+    except:
+        # Do not leave a truncated output behind, it would look up to date
+        try:
+            os.remove(output_file)
+        except OSError:
+            pass
+        raise
+
+
+def IsOutputUpToDate(input_file, output_file):
+    try:
+        return os.path.getmtime(output_file) >= os.path.getmtime(input_file)
+    except OSError:
+        return False
+
+
+@export
+class ConversionServer(object):
+    # Convert comment files posted over HTTP, so that callers converting
+    # many small files do not start a Python interpreter for each one.
+    #
+    # POST /convert?size=WIDTHxHEIGHT&...  with the comment file as the body
+    #                  returns the ASS file, as written by the command line.
+    #                  The other parameters are format, font, fontsize,
+    #                  alpha, duration-marquee, duration-still, filter (may be
+    #                  repeated), protect, reduce and width-model.
+    # GET /health      returns the counters of the server as JSON
+    #
+    # Conversions run in a pool of jobs worker processes.  At most queue_size
+    # more requests wait for a worker, further ones get 503.  address is
+    # HOST:PORT or unix:PATH.
+
+    def __init__(self, address=gDefaultServerAddress, jobs=None, queue_size=64, max_request_size=268435456):
+        import concurrent.futures
+        self.jobs = jobs or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.max_request_size = max_request_size
+        self.slots = threading.BoundedSemaphore(self.jobs + queue_size)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'pending': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'bytes_in': 0, 'bytes_out': 0, 'conversion_seconds': 0.0}
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        import http.server
+        import socketserver
+        handler = type('ConversionRequestHandler', (ConversionRequestHandler, http.server.BaseHTTPRequestHandler), {})
+        family, address = ParseServerAddress(address)
+        if family == 'unix':
+            import stat
+            try:
+                # Remove the socket left by a server that did not close,
+                # but never a file that happens to be at the address
+                if not stat.S_ISSOCK(os.stat(address).st_mode):
+                    raise FileExistsError(_('Not a socket: %s') % address)
+                os.remove(address)
+            except FileNotFoundError:
+                pass
+            self.httpd = type('ThreadingUnixHTTPServer', (socketserver.ThreadingMixIn, socketserver.UnixStreamServer), {})(address, handler)
+        else:
+            self.httpd = http.server.ThreadingHTTPServer(address, handler)
+        self.httpd.daemon_threads = True
+        self.httpd.conversion_server = self
+
+    @property
+    def address(self):
+        address = self.httpd.server_address
+        if isinstance(address, tuple):
+            return '%s:%d' % address[:2]
+        return 'unix:%s' % address
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.executor.shutdown()
+        if isinstance(self.httpd.server_address, str):
+            try:
+                os.remove(self.httpd.server_address)
+            except OSError:
+                pass
+
+    def Reserve(self):
+        # Take a slot for a conversion, or return False if the queue is full
+        if not self.slots.acquire(blocking=False):
+            self.Count('rejected')
+            return False
+        self.Count('pending')
+        return True
+
+    def Release(self):
+        self.Count('pending', -1)
+        self.slots.release()
+
+    def Convert(self, data, params):
+        # Convert in a slot taken by Reserve, and return the name of a
+        # temporary file holding the ASS file, which the caller removes
+        start = time.perf_counter()
+        try:
+            path = self.executor.submit(ConvertServerRequest, data, params).result()
+        except:
+            self.Count('failed')
+            raise
+        else:
+            self.Count('completed')
+            self.Count('bytes_in', len(data))
+            self.Count('bytes_out', os.path.getsize(path))
+            return path
+        finally:
+            self.Count('conversion_seconds', time.perf_counter() - start)
+
+    def Count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def Health(self):
+        with self.lock:
+            res = dict(self.counters)
+        res['status'] = 'ok'
+        res['uptime'] = time.time() - self.started
+        res['workers'] = self.jobs
+        res['queue_size'] = self.queue_size
+        res['active'] = min(res['pending'], self.jobs)
+        res['queued'] = res['pending'] - res['active']
+        del res['pending']
+        return res
+
+
+class ConversionRequestHandler(object):
+    # Mixed into http.server.BaseHTTPRequestHandler by ConversionServer
+
+    def do_GET(self):
+        import json
+        import urllib.parse
+        if urllib.parse.urlsplit(self.path).path != '/health':
+            return self.SendError(404, _('Not found'))
+        self.SendBody(200, 'application/json', json.dumps(self.server.conversion_server.Health()).encode('utf-8'))
+
+    def do_POST(self):
+        import urllib.parse
+        server = self.server.conversion_server
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/convert':
+            return self.SendError(404, _('Not found'))
+        try:
+            params = ParseServerRequest(urllib.parse.parse_qs(url.query))
+        except ValueError as e:
+            return self.SendError(400, str(e))
+        try:
+            length = int(self.headers['Content-Length'])
+        except (TypeError, ValueError):
+            return self.SendError(411, _('Content-Length is required'))
+        if length > server.max_request_size:
+            return self.SendError(413, _('Request is larger than %d bytes') % server.max_request_size)
+        if not server.Reserve():
+            self.SendError(503, _('Too many requests are waiting'), {'Retry-After': '1'})
+            # Let the client finish sending, so that it reads the response
+            # rather than a reset connection
+            while length > 0:
+                chunk = self.rfile.read(min(length, 65536))
+                if not chunk:
+                    break
+                length -= len(chunk)
+            return
+        try:
+            data = self.rfile.read(length)
+            try:
+                path = server.Convert(data, params)
+            except Exception as e:
+                return self.SendError(422, _('Failed to convert: %s') % e)
+        finally:
+            server.Release()
+        try:
+            with open(path, 'rb') as f:
+                self.SendFile(200, 'text/x-ssa; charset=utf-8', f, os.fstat(f.fileno()).st_size)
+        finally:
+            os.remove(path)
+
+    def SendBody(self, code, content_type, body, headers={}):
+        self.SendFile(code, content_type, io.BytesIO(body), len(body), headers)
+
+    def SendFile(self, code, content_type, f, length, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        for chunk in iter(lambda: f.read(65536), b''):
+            self.wfile.write(chunk)
+
+    def SendError(self, code, message, headers={}):
+        self.SendBody(code, 'text/plain; charset=utf-8', (message + '\n').encode('utf-8'), headers)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, format, *args):
+        logging.info('%s %s' % (self.address_string(), format % args))
+
+
+def ParseServerAddress(address):
+    # Return ('inet', (host, port)) or ('unix', path) for HOST:PORT, :PORT,
+    # PORT or unix:PATH
+    if address.startswith('unix:'):
+        return 'unix', address[5:]
+    host, _sep, port = address.rpartition(':')
+    try:
+        return 'inet', (host.strip('[]') or '127.0.0.1', int(port))
+    except ValueError:
+        raise ValueError(_('Invalid server address: %r') % address)
+
+
+def ParseServerRequest(query):
+    # Turn the query of a /convert request into arguments of Danmaku2ASS
+    def Get(name, convert=str, default=None):
+        values = query.get(name)
+        if not values:
+            return default
+        try:
+            return convert(values[-1])
+        except ValueError:
+            raise ValueError(_('Invalid %s: %r') % (name, values[-1]))
+    params = {}
+    params['stage_width'], params['stage_height'] = ParseStageSize(Get('size', default=''))
+    params['input_format'] = Get('format', default='autodetect')
+    if params['input_format'] != 'autodetect' and params['input_format'] not in CommentFormatMap:
+        raise ValueError(_('Unknown comment file format: %s') % params['input_format'])
+    params['font_face'] = Get('font', default=DefaultFontFace())
+    params['font_size'] = Get('fontsize', float, 25.0)
+    params['text_opacity'] = Get('alpha', float, 1.0)
+    params['duration_marquee'] = Get('duration-marquee', float, 5.0)
+    params['duration_still'] = Get('duration-still', float, 5.0)
+    params['comment_filter'] = query.get('filter', [])
+    CommentFilter(params['comment_filter'])
+    params['reserve_blank'] = Get('protect', int, 0)
+    params['is_reduce_comments'] = Get('reduce', default='') in ('1', 'true', 'yes')
+    params['max_per_second'] = Get('max-per-second', int)
+    params['max_simultaneous'] = Get('max-simultaneous', int)
+    params['collapse_window'] = Get('collapse-window', float)
+    params['start'] = Get('start', ParseTime)
+    params['end'] = Get('end', ParseTime)
+    params['rebase'] = Get('rebase', default='') in ('1', 'true', 'yes')
+    params['warmup'] = Get('warmup', float)
+    params['width_model'] = Get('width-model', default='eastasian')
+    if params['width_model'] not in ('eastasian', 'length'):
+        raise ValueError(_('Unknown width model: %r') % params['width_model'])
+    return params
+
+
+def ConvertServerRequest(data, params):
+    # Run in a worker process of ConversionServer, return the name of a
+    # temporary file holding the ASS file
+    import tempfile
+    params = dict(params)
+    fd, path = tempfile.mkstemp(prefix='danmaku2ass-', suffix='.ass')
+    try:
+        with open(fd, 'w', encoding='utf-8-sig', errors='replace', newline='\r\n') as f:
+            Danmaku2ASS([io.BytesIO(data)], params.pop('input_format'), f, params.pop('stage_width'), params.pop('stage_height'), **params)
+    except:
+        os.remove(path)
+        raise
+    return path
+
+
+@export
+def Danmaku2ASSRemote(server_address, input_file, input_format, output_file, stage_width, stage_height, reserve_blank=0, font_face=None, font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, width_model='eastasian', max_per_second=None, max_simultaneous=None, collapse_window=None, start=None, end=None, rebase=False, warmup=None):
+    # Same as Danmaku2ASS with a single input file, converted by a
+    # ConversionServer listening on server_address
+    import http.client
+    import urllib.parse
+    if font_face is None:
+        font_face = DefaultFontFace()
+    comment_filters = [comment_filter] if comment_filter else []
     if comment_filters_file:
         with open(comment_filters_file, 'r') as f:
             d = f.readlines()
             comment_filters.extend([i.strip() for i in d])
-    filters_regex = []
-    for comment_filter in comment_filters:
-        try:
-            if comment_filter:
-                filters_regex.append(re.compile(comment_filter))
-        except:
-            raise ValueError(_('Invalid regular expression: %s') % comment_filter)
-    fo = None
-    comments = ReadComments(input_files, input_format, font_size)
+    query = [('size', '%dx%d' % (stage_width, stage_height)), ('format', input_format), ('font', font_face), ('fontsize', repr(font_size)), ('alpha', repr(text_opacity)), ('duration-marquee', repr(duration_marquee)), ('duration-still', repr(duration_still)), ('protect', str(reserve_blank)), ('width-model', width_model)]
+    if is_reduce_comments:
+        query.append(('reduce', '1'))
+    if max_per_second is not None:
+        query.append(('max-per-second', str(max_per_second)))
+    if max_simultaneous is not None:
+        query.append(('max-simultaneous', str(max_simultaneous)))
+    if collapse_window:
+        query.append(('collapse-window', repr(collapse_window)))
+    if start is not None:
+        query.append(('start', repr(start)))
+    if end is not None:
+        query.append(('end', repr(end)))
+    if rebase:
+        query.append(('rebase', '1'))
+    if warmup is not None:
+        query.append(('warmup', repr(warmup)))
+    query.extend(('filter', i) for i in comment_filters)
+    family, address = ParseServerAddress(server_address)
+    if family == 'unix':
+        conn = type('UnixHTTPConnection', (UnixHTTPConnection, http.client.HTTPConnection), {})(address)
+    else:
+        conn = http.client.HTTPConnection(*address)
     try:
+        with ConvertToFile(input_file, 'rb') as f:
+            data = f.read()
+        conn.request('POST', '/convert?' + urllib.parse.urlencode(query), data, {'Content-Type': 'application/octet-stream'})
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError(_('Conversion server returned %d: %s') % (response.status, response.read().decode('utf-8', 'replace').strip()))
         if output_file:
-            fo = ConvertToFile(output_file, 'w', encoding='utf-8-sig', errors='replace', newline='\r\n')
+            fo = ConvertToFile(output_file, 'wb')
         else:
-            fo = sys.stdout
-        ProcessComments(comments, fo, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, filters_regex, is_reduce_comments, progress_callback)
+            fo = sys.stdout.buffer
+        try:
+            for chunk in iter(lambda: response.read(65536), b''):
+                fo.write(chunk)
+        finally:
+            if output_file and fo != output_file:
+                fo.close()
     finally:
-        if output_file and fo != output_file:
-            fo.close()
+        conn.close()
+
+
+class UnixHTTPConnection(object):
+    # Mixed into http.client.HTTPConnection by Danmaku2ASSRemote
+
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.unix_path = path
+
+    def connect(self):
+        import socket
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+#
+# Comment archives
+#
+# The sorted comments returned by ReadComments, stored column by column so
+# that they are loaded by mapping the file instead of parsing it again.
+# All numbers are little-endian and every column starts at a multiple of 8:
+#
+#     magic, version:  ArchiveMagic, then uint32 ArchiveVersion and padding
+#     columns:         One per CommentTable column, of a kind chosen when
+#                      written:
+#                        d, q:  An array of doubles or int64s
+#                        c:     An array of uint8 codes into a list of up to
+#                               256 values kept in the index, e.g. pos
+#                        s:     UTF-8 texts one after another, then uint64
+#                               offsets of where each text starts and the
+#                               last one ends
+#                        j:     As s, each text being a JSON value, for
+#                               columns of mixed types
+#     index:           UTF-8 JSON of the number of comments, the font size,
+#                      the width model key and where each column is
+#     footer:          uint64 offset and length of the index
+#
+
+ArchiveMagic = b'D2ASS\x00AR'
+ArchiveVersion = 1
+
+
+class ArchiveTexts(object):
+    # A column of texts decoded from the archive as they are read, parsed
+    # as JSON if decode is json.loads
+
+    __slots__ = ('offsets', 'blob', 'decode')
+
+    def __init__(self, offsets, blob, decode=None):
+        self.offsets = offsets
+        self.blob = blob
+        self.decode = decode
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[k] for k in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('column index out of range')
+        value = str(self.blob[self.offsets[index]:self.offsets[index + 1]], 'utf-8', 'surrogatepass')
+        return self.decode(value) if self.decode else value
+
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+
+
+class ArchiveCodes(object):
+    # A column of values looked up from their uint8 codes in the archive
+
+    __slots__ = ('codes', 'values')
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(map(self.values.__getitem__, self.codes[index]))
+        return self.values[self.codes[index]]
+
+    def __iter__(self):
+        return map(self.values.__getitem__, self.codes)
+
+
+@export
+def WriteCommentArchive(comments, filename_or_file, font_size=25.0, width_model=None):
+    # comments are sorted as returned by ReadComments with the same
+    # font_size and width_model, other iterables of comments are sorted here
+    import json
+    import struct
+    if not isinstance(comments, CommentTable):
+        comments = CommentTable(comments)
+        comments.sort()
+    if width_model is None:
+        width_model = CurrentWidthModel.model
+    index = {'count': len(comments), 'font_size': font_size, 'width_model': getattr(width_model, 'key', None), 'columns': []}
+    with ConvertToFile(filename_or_file, 'wb') as f:
+        offset = 0
+
+        def Write(data):
+            # Write data padded to a multiple of 8, return where it starts
+            nonlocal offset
+            start = offset
+            data = memoryview(data).cast('B')
+            f.write(data)
+            offset += len(data)
+            if offset % 8:
+                f.write(b'\x00' * (8 - offset % 8))
+                offset += 8 - offset % 8
+            return [start, len(data)]
+
+        Write(ArchiveMagic + struct.pack('<I', ArchiveVersion))
+        for name in CommentTable.__slots__:
+            column = getattr(comments, name)
+            typecode = getattr(column, 'typecode', None) or getattr(column, 'format', None)
+            if typecode in ('d', 'q'):
+                data = array.array(typecode, column) if sys.byteorder != 'little' or not isinstance(column, array.array) else column
+                if sys.byteorder != 'little':
+                    data.byteswap()
+                index['columns'].append({'name': name, 'kind': typecode, 'data': Write(data)})
+                continue
+            codes = {}
+            if name != 'comment':
+                for value in column:
+                    codes.setdefault((type(value), value), len(codes))
+                    if len(codes) > 256:
+                        break
+            if 0 < len(codes) <= 256:
+                data = array.array('B', (codes[(type(value), value)] for value in column))
+                index['columns'].append({'name': name, 'kind': 'c', 'values': [value for t, value in codes], 'data': Write(data)})
+                continue
+            if all(isinstance(value, str) for value in column):
+                kind, encode = 's', str
+            else:
+                kind, encode = 'j', json.dumps
+            start = offset
+            offsets = array.array('Q', [0])
+            for k in range(0, len(column), LayoutBlockSize):
+                texts = [encode(value).encode('utf-8', 'surrogatepass') for value in column[k:k + LayoutBlockSize]]
+                for text in texts:
+                    offsets.append(offsets[-1] + len(text))
+                f.write(b''.join(texts))
+                offset = start + offsets[-1]
+            blob = [start, offset - start]
+            Write(b'')
+            if sys.byteorder != 'little':
+                offsets.byteswap()
+            index['columns'].append({'name': name, 'kind': kind, 'data': blob, 'offsets': Write(offsets)})
+        data = Write(json.dumps(index).encode('utf-8'))
+        f.write(struct.pack('<QQ', *data))
+
+
+def IsCommentArchive(filename):
+    # Whether the file is an archive, from its first bytes
+    with ConvertToFile(filename, 'rb') as f:
+        return f.read(len(ArchiveMagic)) == ArchiveMagic
 
 
 @export
-def ReadComments(input_files, input_format, font_size=25.0, progress_callback=None):
+def LoadCommentArchive(filename_or_file, font_size=25.0, width_model=None):
+    # Return the comments of an archive as a CommentTable whose columns are
+    # views of the mapped file.  Regular files are mapped, other binary
+    # streams are read into memory first.  The font size must be the one
+    # the archive was written with.  If the width model differs, widths are
+    # estimated again into a copied column.
+    import json
+    import mmap
+    import struct
+    with ConvertToFile(filename_or_file, 'rb') as f:
+        buffered = f if isinstance(f, io.BufferedReader) else None
+        if buffered is not None and isinstance(buffered.raw, io.FileIO):
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = f.read()
+    data = memoryview(data)
+    if data[:len(ArchiveMagic)] != ArchiveMagic or len(data) < 16 + 16:
+        raise ValueError(_('Not a comment archive: %s') % getattr(filename_or_file, 'name', filename_or_file))
+    version, = struct.unpack_from('<I', data, len(ArchiveMagic))
+    if version != ArchiveVersion:
+        raise ValueError(_('Unsupported comment archive version: %d') % version)
+    index_offset, index_length = struct.unpack_from('<QQ', data, len(data) - 16)
+    index = json.loads(str(data[index_offset:index_offset + index_length], 'utf-8'))
+    if font_size != index['font_size']:
+        # Readers scale sizes in their own ways, which can not be redone
+        raise ValueError(_('Comment archive %s was saved with font size %s') % (getattr(filename_or_file, 'name', filename_or_file), index['font_size']))
+
+    def View(place, typecode):
+        view = data[place[0]:place[0] + place[1]].cast(typecode)
+        if sys.byteorder != 'little' and typecode != 'B':
+            view = array.array(typecode, view.tobytes())
+            view.byteswap()
+        return view
+
+    columns = []
+    for column in index['columns']:
+        kind = column['kind']
+        if kind in ('d', 'q'):
+            columns.append(View(column['data'], kind))
+        elif kind == 'c':
+            columns.append(ArchiveCodes(View(column['data'], 'B'), tuple(column['values'])))
+        else:
+            blob = data[column['data'][0]:column['data'][0] + column['data'][1]]
+            columns.append(ArchiveTexts(View(column['offsets'], 'Q'), blob, json.loads if kind == 'j' else None))
+    comments = CommentTable.FromColumns(columns)
+    if width_model is None:
+        width_model = CurrentWidthModel.model
+    width_model_key = getattr(width_model, 'key', None)
+    if width_model_key is None or width_model_key != index['width_model']:
+        with UseWidthModel(width_model):
+            comments.width = array.array('d', (CalculateLength(c[3]) * c[6] if isinstance(c[4], int) else c[8] for c in comments))
+    return comments
+
+
+@export
+def ReadComments(input_files, input_format, font_size=25.0, progress_callback=None, memory_limit=None, stats=None, cache_dir=None, cache_size=1073741824, width_model=None, dedupe=False):
     if isinstance(input_files, bytes):
         input_files = str(bytes(input_files).decode('utf-8', 'replace'))
     if isinstance(input_files, str):
         input_files = [input_files]
     else:
         input_files = list(input_files)
-    comments = []
-    for idx, i in enumerate(input_files):
+    if stats is None:
+        stats = ConversionStats()
+    if width_model is None:
+        width_model = CurrentWidthModel.model
+    cache = None
+    # Archives load faster than hashing them for the cache would take
+    if cache_dir and not memory_limit and getattr(width_model, 'key', None) and all(isinstance(i, (str, bytes)) for i in input_files) and not any(IsCommentArchive(i) for i in input_files):
+        cache = CommentCache(cache_dir, cache_size)
+        with stats.Timer('read'):
+            cache_key = cache.Key(input_files, input_format, font_size, width_model.key, dedupe)
+            cached = cache.Load(cache_key)
+        stats.cache_hit = cached is not None
+        if cached is not None:
+            columns, comments_read, stats.duplicates = cached
+            comments = CommentTable.FromColumns(columns)
+            for file_format, count in comments_read.items():
+                stats.comments_read[file_format] = stats.comments_read.get(file_format, 0) + count
+            return comments
+    if memory_limit:
+        comments = ExternalCommentSorter(memory_limit)
+    else:
+        comments = CommentTable()
+    comments_read = {}
+    duplicate_filter = DuplicateFilter() if dedupe else None
+    archived = False
+    with stats.Timer('read'), UseWidthModel(width_model):
+        for idx, i in enumerate(input_files):
+            if progress_callback:
+                progress_callback(idx, len(input_files))
+            with OpenCommentFile(i) as (f, head):
+                if input_format == 'autodetect':
+                    file_format = ProbeCommentFormat(io.StringIO(head))
+                    CommentProcessor = CommentFormatMap.get(file_format)
+                    if not CommentProcessor:
+                        raise ValueError(
+                            _('Failed to detect comment file format: %s') % i
+                        )
+                else:
+                    file_format = input_format
+                    CommentProcessor = CommentFormatMap.get(input_format)
+                    if not CommentProcessor:
+                        raise ValueError(
+                            _('Unknown comment file format: %s') % input_format
+                        )
+                count = len(comments)
+                if CommentProcessor is ReadCommentsArchive and len(input_files) == 1 and duplicate_filter is None and isinstance(comments, CommentTable):
+                    # A single archive is sorted already, use it as mapped
+                    comments = LoadCommentArchive(getattr(f, 'buffer', f), font_size, width_model)
+                    archived = True
+                else:
+                    if duplicate_filter is not None and file_format in RowIdFormats:
+                        read = duplicate_filter(CommentProcessor(FilterBadChars(f), font_size, row_ids=True), file_format)
+                    else:
+                        read = CommentProcessor(f if CommentProcessor is ReadCommentsArchive else FilterBadChars(f), font_size)
+                        if duplicate_filter is not None:
+                            read = duplicate_filter(read, file_format)
+                    comments.extend(read)
+                comments_read[file_format] = comments_read.get(file_format, 0) + len(comments) - count
         if progress_callback:
-            progress_callback(idx, len(input_files))
-        with ConvertToFile(i, 'r', encoding='utf-8', errors='replace') as f:
-            s = f.read()
-            str_io = io.StringIO(s)
-            if input_format == 'autodetect':
-                CommentProcessor = GetCommentProcessor(str_io)
-                if not CommentProcessor:
-                    raise ValueError(
-                        _('Failed to detect comment file format: %s') % i
-                    )
-            else:
-                CommentProcessor = CommentFormatMap.get(input_format)
-                if not CommentProcessor:
-                    raise ValueError(
-                        _('Unknown comment file format: %s') % input_format
-                    )
-            comments.extend(CommentProcessor(FilterBadChars(str_io), font_size))
-    if progress_callback:
-        progress_callback(len(input_files), len(input_files))
-    comments.sort()
+            progress_callback(len(input_files), len(input_files))
+    for file_format, count in comments_read.items():
+        stats.comments_read[file_format] = stats.comments_read.get(file_format, 0) + count
+    if duplicate_filter is not None:
+        stats.duplicates = duplicate_filter.dropped
+        del duplicate_filter
+    with stats.Timer('sort'):
+        if not archived:
+            comments.sort()
+    if cache is not None and not archived:
+        # Only plain columns are stored, which unpickle however this module
+        # was loaded, as a script or imported
+        cache.Store(cache_key, ([getattr(comments, name) for name in CommentTable.__slots__], comments_read, stats.duplicates))
     return comments
 
 
@@ -940,66 +3020,112 @@ def GetCommentProcessor(input_file):
 
 
 def mainProcessAll():
+    import argparse
     import glob
-    from os.path import isfile
-    
+
+    parser = argparse.ArgumentParser(prog='%s all' % os.path.basename(sys.argv[0]))
+    parser.add_argument('size', metavar=_('WIDTHxHEIGHT'), nargs='?', help=_('Stage size in pixels [default: %s]') % ('%dx%d' % (gDefaultSizeWidth, gDefaultSizeHeight)))
+    parser.add_argument('-j', '--jobs', metavar=_('N'), help=_('Number of files to convert in parallel [default: %s]') % 1, type=int, default=1)
+    args = parser.parse_args(sys.argv[2:])
+
     width = gDefaultSizeWidth
     height = gDefaultSizeHeight
-    
+
     widthHeightChanged = False
-    if len(sys.argv) > 2:
+    if args.size:
         try:
-            width, height = str(sys.argv[2]).split('x', 1)
+            width, height = str(args.size).split('x', 1)
             width = int(width)
             height = int(height)
             widthHeightChanged = True
         except ValueError:
-            print('Invalid argument: ' + sys.argv[2])
-    
+            width = gDefaultSizeWidth
+            height = gDefaultSizeHeight
+            print('Invalid argument: ' + args.size)
+
     if not widthHeightChanged:
         print('Using default width x height: ' + str(width) + 'x' + str(height))
-    
+
+    tasks = []
+    for suffix in ('.comments.json', '.json', '.xml'):
+        for filename in glob.glob('*' + suffix):
+            if suffix == '.json' and filename.endswith('.comments.json'):
+                continue
+            tasks.append((filename, filename[:len(filename)-len(suffix)] + '.ass'))
+
     filesProcessed = 0
-    
-    for filename in glob.glob('*.comments.json'):
-        newfilename = filename[:len(filename)-len('.comments.json')] + '.ass'
-        if not isfile(newfilename):
-            print("Processing: " + newfilename)
-            Danmaku2ASS(filename, 'autodetect', newfilename, gDefaultSizeWidth, gDefaultSizeHeight)
-            filesProcessed += 1
-    
-    for filename in glob.glob('*.json'):
-        if filename.endswith('.json'):
-            continue
-        newfilename = filename[:len(filename)-len('.json')] + '.ass'
-        if not isfile(newfilename):
-            print("Processing: " + newfilename)
-            Danmaku2ASS(filename, 'autodetect', newfilename, gDefaultSizeWidth, gDefaultSizeHeight)
-            filesProcessed += 1
-    
-    for filename in glob.glob('*.xml'):
-        newfilename = filename[:len(filename)-len('.xml')] + '.ass'
-        if not isfile(newfilename):
-            print("Processing: " + newfilename)
-            Danmaku2ASS(filename, 'autodetect', newfilename, gDefaultSizeWidth, gDefaultSizeHeight)
-            filesProcessed += 1
-    
+
+    for filename, newfilename, error in Danmaku2ASSBatch(tasks, width, height, jobs=args.jobs):
+        if error is None:
+            print("Processed: " + newfilename)
+        else:
+            logging.error(_('Failed to convert %s: %s') % (filename, error))
+        filesProcessed += 1
+
     if filesProcessed == 0:
         print("Nothing to process")
 
 
+def ParseStageSize(size):
+    try:
+        width, height = str(size).split('x', 1)
+        return int(width), int(height)
+    except ValueError:
+        raise ValueError(_('Invalid stage size: %r') % size)
+
+
+def ParseTime(value):
+    # Seconds from SECONDS, MM:SS or HH:MM:SS
+    parts = str(value).split(':')
+    try:
+        if len(parts) > 3:
+            raise ValueError
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        raise ValueError(_('Invalid time: %r') % value)
+
+
+def mainServe():
+    import argparse
+    import signal
+    parser = argparse.ArgumentParser(prog='%s serve' % os.path.basename(sys.argv[0]))
+    parser.add_argument('-l', '--listen', metavar=_('ADDRESS'), help=_('HOST:PORT or unix:PATH to listen on [default: %s]') % gDefaultServerAddress, default=gDefaultServerAddress)
+    parser.add_argument('-j', '--jobs', metavar=_('N'), help=_('Number of worker processes [default: number of CPUs]'), type=int)
+    parser.add_argument('-q', '--queue', metavar=_('N'), help=_('Number of requests that may wait for a worker [default: %s]') % 64, type=int, default=64)
+    args = parser.parse_args(sys.argv[2:])
+    logging.getLogger().setLevel(logging.INFO)
+    server = ConversionServer(args.listen, args.jobs, args.queue)
+    logging.info(_('Listening on %s') % server.address)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
 def main():
+    import argparse
+    import json
     logging.basicConfig(format='%(levelname)s: %(message)s')
     if len(sys.argv) > 1 and sys.argv[1] == "all":
         mainProcessAll()
         return
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        mainServe()
+        return
     if len(sys.argv) == 1:
         sys.argv.append('--help')
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--format', metavar=_('FORMAT'), help=_('Format of input file (autodetect|%s) [default: autodetect]') % '|'.join(i for i in CommentFormatMap), default='autodetect')
     parser.add_argument('-o', '--output', metavar=_('OUTPUT'), help=_('Output file'))
-    parser.add_argument('-s', '--size', metavar=_('WIDTHxHEIGHT'), required=True, help=_('Stage size in pixels'))
-    parser.add_argument('-fn', '--font', metavar=_('FONT'), help=_('Specify font face [default: %s]') % _('(FONT) sans-serif')[7:], default=_('(FONT) sans-serif')[7:])
+    parser.add_argument('-s', '--size', metavar=_('WIDTHxHEIGHT'), help=_('Stage size in pixels'))
+    parser.add_argument('-t', '--target', metavar=_('WIDTHxHEIGHT:OUTPUT'), action='append', default=[], help=_('Also write OUTPUT for another stage size, may be repeated'))
+    parser.add_argument('-fn', '--font', metavar=_('FONT'), help=_('Specify font face [default: %s]') % DefaultFontFace(), default=DefaultFontFace())
     parser.add_argument('-fs', '--fontsize', metavar=_('SIZE'), help=(_('Default font size [default: %s]') % 25), type=float, default=25.0)
     parser.add_argument('-a', '--alpha', metavar=_('ALPHA'), help=_('Text opacity'), type=float, default=1.0)
     parser.add_argument('-dm', '--duration-marquee', metavar=_('SECONDS'), help=_('Duration of scrolling comment display [default: %s]') % 5, type=float, default=5.0)
@@ -1007,16 +3133,68 @@ def main():
     parser.add_argument('-fl', '--filter', help=_('Regular expression to filter comments'))
     parser.add_argument('-flf', '--filter-file', help=_('Regular expressions from file (one line one regex) to filter comments'))
     parser.add_argument('-p', '--protect', metavar=_('HEIGHT'), help=_('Reserve blank on the bottom of the stage'), type=int, default=0)
+    parser.add_argument('-wm', '--width-model', metavar=_('MODEL'), help=_('Estimate comment widths by East Asian Width classes or by character count (eastasian|length) [default: eastasian]'), choices=('eastasian', 'length'), default='eastasian')
+    parser.add_argument('-ff', '--font-file', metavar=_('FONT_FILE'), help=_('Estimate comment widths from the metrics of a font file, requires fontTools'))
     parser.add_argument('-r', '--reduce', action='store_true', help=_('Reduce the amount of comments if stage is full'))
+    parser.add_argument('-mps', '--max-per-second', metavar=_('N'), help=_('Keep at most N comments in each second, shorter ones first'), type=int)
+    parser.add_argument('-msi', '--max-simultaneous', metavar=_('N'), help=_('Keep at most N comments of each type on the stage at once'), type=int)
+    parser.add_argument('-dd', '--dedupe', action='store_true', help=_('Drop comments found in more than one input file'))
+    parser.add_argument('-cw', '--collapse-window', metavar=_('SECONDS'), help=_('Merge comments repeating the same text within SECONDS into one with a count'), type=float)
+    parser.add_argument('--start', metavar=_('TIME'), help=_('Only write comments from TIME on, in seconds, MM:SS or HH:MM:SS'), type=ParseTime)
+    parser.add_argument('--end', metavar=_('TIME'), help=_('Only write comments before TIME'), type=ParseTime)
+    parser.add_argument('--rebase', action='store_true', help=_('Count the times written from --start'))
+    parser.add_argument('--warmup', metavar=_('SECONDS'), help=_('Lay out the comments of SECONDS before --start without writing them, inf to match a full conversion exactly [default: twice the longest duration]'), type=float)
+    parser.add_argument('-j', '--jobs', metavar=_('N'), help=_('Format the output in N processes while comments are laid out [default: %s]') % 1, type=int, default=1)
+    parser.add_argument('-c', '--cache-dir', metavar=_('DIRECTORY'), help=_('Cache parsed comments in this directory'))
+    parser.add_argument('-cs', '--cache-size', metavar=_('MEGABYTES'), help=_('Size limit of the cache directory [default: %s]') % 1024, type=float, default=1024.0)
+    parser.add_argument('--stats', metavar=_('FILE'), help=_('Write counters and timings of the conversion to a JSON file'))
+    parser.add_argument('--server', metavar=_('ADDRESS'), help=_('Convert on a server started with "%s serve", at HOST:PORT or unix:PATH') % os.path.basename(sys.argv[0]))
+    parser.add_argument('-sa', '--save-archive', metavar=_('ARCHIVE'), help=_('Save the comments read to an archive, which loads without parsing with --format Archive'))
+    parser.add_argument('-ml', '--memory-limit', metavar=_('MEGABYTES'), help=_('Sort comments on disk once they take more memory than this'), type=float)
     parser.add_argument('file', metavar=_('FILE'), nargs='+', help=_('Comment file to be processed'))
     args = parser.parse_args()
+    if not args.size and not args.target and not args.save_archive:
+        parser.error(_('either -s/--size, -t/--target or -sa/--save-archive is required'))
+    if args.output and not args.size:
+        parser.error(_('-o/--output requires -s/--size, use -t/--target for outputs of other sizes'))
+    if args.server:
+        # Reject options the server does not take.  Those about reading the
+        # files still apply to the archive saved by -sa/--save-archive.
+        local = [('--stats', args.stats), ('-j/--jobs', args.jobs != 1)]
+        if not args.save_archive:
+            local += [('-ff/--font-file', args.font_file), ('-c/--cache-dir', args.cache_dir), ('-dd/--dedupe', args.dedupe), ('-ml/--memory-limit', args.memory_limit)]
+        for option, value in local:
+            if value:
+                parser.error(_('%s cannot be used with --server') % option)
+    targets = []
     try:
-        width, height = str(args.size).split('x', 1)
-        width = int(width)
-        height = int(height)
-    except ValueError:
-        raise ValueError(_('Invalid stage size: %r') % args.size)
-    Danmaku2ASS(args.file, args.format, args.output, width, height, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.filter, args.filter_file, args.reduce)
+        if args.size:
+            targets.append(ParseStageSize(args.size) + (args.output,))
+        for target in args.target:
+            size, sep, output = str(target).partition(':')
+            if not output:
+                parser.error(_('-t/--target takes WIDTHxHEIGHT:OUTPUT, got %r') % target)
+            targets.append(ParseStageSize(size) + (output,))
+    except ValueError as e:
+        parser.error(str(e))
+    memory_limit = int(args.memory_limit * 1048576) if args.memory_limit else None
+    if args.save_archive:
+        width_model = GetWidthModel(args.width_model, args.font_file, args.cache_dir, int(args.cache_size * 1048576))
+        comments = ReadComments(args.file, args.format, args.fontsize, memory_limit=memory_limit, cache_dir=args.cache_dir, cache_size=int(args.cache_size * 1048576), width_model=width_model, dedupe=args.dedupe)
+        WriteCommentArchive(comments, args.save_archive, args.fontsize, width_model)
+        if not targets:
+            return
+        # Convert from the archive, rather than reading the files again
+        args.file, args.format, args.dedupe = [args.save_archive], 'Archive', False
+    if args.server:
+        if len(targets) != 1 or len(args.file) != 1:
+            parser.error(_('--server converts one file to one stage size'))
+        Danmaku2ASSRemote(args.server, args.file[0], args.format, targets[0][2], targets[0][0], targets[0][1], args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.filter, args.filter_file, args.reduce, args.width_model, args.max_per_second, args.max_simultaneous, args.collapse_window, args.start, args.end, args.rebase, args.warmup)
+        return
+    stats = Danmaku2ASSMultiStage(args.file, args.format, targets, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.filter, args.filter_file, args.reduce, memory_limit=memory_limit, detailed_stats=bool(args.stats), cache_dir=args.cache_dir, cache_size=int(args.cache_size * 1048576), width_model=args.width_model, font_file=args.font_file, max_per_second=args.max_per_second, max_simultaneous=args.max_simultaneous, dedupe=args.dedupe, collapse_window=args.collapse_window, start=args.start, end=args.end, rebase=args.rebase, warmup=args.warmup, jobs=args.jobs)
+    if args.stats:
+        with open(args.stats, 'w') as f:
+            json.dump(vars(stats), f, indent=2)
 
 
 if __name__ == '__main__':
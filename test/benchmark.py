@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+# Benchmark Danmaku2ASS with synthetic comment files of any size.
+#
+# Each format in CommentFormatMap is generated with several profiles, then
+# probing, parsing, sorting, layout and writing are timed separately.
+#
+#     ./benchmark.py -n 100000 --save-baseline baseline.json
+#     ./benchmark.py -n 100000 --baseline baseline.json
+#
+# The second run exits with 1 if any phase got slower than the baseline by
+# more than the tolerance.
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.sax.saxutils
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'danmaku2ass.py')).load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'danmaku2ass.py'))
+
+
+# rate:       Comments per second of video
+# positioned: Ratio of positioned comments, or of top and bottom comments
+#             for formats without positioned comments
+# multiline:  Ratio of comments with more than one line
+Profiles = {
+    'dense': {'rate': 50.0, 'positioned': 0.0, 'multiline': 0.0},
+    'sparse': {'rate': 0.5, 'positioned': 0.0, 'multiline': 0.0},
+    'positioned': {'rate': 5.0, 'positioned': 0.5, 'multiline': 0.0},
+    'multiline': {'rate': 10.0, 'positioned': 0.0, 'multiline': 0.5},
+}
+
+Words = ['2333', 'hello', 'world', '前方高能', '草', 'ｗｗｗ', 'ハム太郎', '弹幕', 'nice', '666', 'awsl', '哈哈哈哈']
+Colors = [0xffffff, 0xffffff, 0xffffff, 0xff0000, 0x00ff00, 0x0000ff, 0xffff00, 0x000000]
+
+
+# Yield (timeline, kind, lines, size, color, timestamp)
+# kind is one of 'scroll', 'reverse', 'top', 'bottom' and 'positioned'
+def GenerateComments(count, profile, rng):
+    timeline = 0.0
+    for i in range(count):
+        timeline += rng.expovariate(profile['rate'])
+        if rng.random() < profile['positioned']:
+            kind = 'positioned'
+        else:
+            kind = rng.choice(('scroll',) * 12 + ('reverse', 'top', 'bottom'))
+        if rng.random() < profile['multiline']:
+            line_count = rng.randint(2, 4)
+        else:
+            line_count = 1
+        lines = [' '.join(rng.choice(Words) for j in range(rng.randint(1, 4))) for j in range(line_count)]
+        yield (timeline, kind, lines, rng.choice((18, 25, 25, 25, 36)), rng.choice(Colors), 1400000000 + i)
+
+
+def XMLEscape(s):
+    return xml.sax.saxutils.escape(s, {'"': '&quot;'})
+
+
+def GenerateBilibili(count, profile, rng, version=1):
+    BilibiliModes = {'scroll': '1', 'bottom': '4', 'top': '5', 'reverse': '6', 'positioned': '7'}
+    if version == 1:
+        res = ['<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver>']
+    else:
+        res = ['<?xml version="2.0" encoding="UTF-8"?><i>']
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        if kind == 'positioned':
+            text = json.dumps([rng.randint(0, 672), rng.randint(0, 438), '1-0.5', 4.5, '/n'.join(lines), rng.choice((0, 30, 90)), rng.choice((0, 45)), rng.randint(0, 672), rng.randint(0, 438), 3000, 0, 'true', 'SimHei'], ensure_ascii=False)
+        else:
+            text = '/n'.join(lines)
+        if version == 1:
+            res.append('<d p="%.5f,%s,%d,%d,%d,0,%08x,%d">%s</d>' % (timeline, BilibiliModes[kind], size, color, timestamp, i, i, XMLEscape(text)))
+        else:
+            res.append('<d p="%d,0,%d,%s,%d,%d,%d,0,%08x">%s</d>' % (i, timeline * 1000, BilibiliModes[kind], size, color, timestamp, i, XMLEscape(text)))
+    res.append('</i>')
+    return ''.join(res)
+
+
+def GenerateBilibili2(count, profile, rng):
+    return GenerateBilibili(count, profile, rng, version=2)
+
+
+NiconicoMails = {'scroll': '', 'reverse': '', 'top': 'ue', 'bottom': 'shita', 'positioned': 'ue'}
+NiconicoColors = {0xffffff: 'white', 0xff0000: 'red', 0x00ff00: 'green', 0x0000ff: 'blue', 0xffff00: 'yellow', 0x000000: 'black'}
+NiconicoSizes = {18: 'small', 25: '', 36: 'big'}
+
+
+def GenerateNiconicoMail(kind, size, color):
+    return [i for i in (NiconicoMails[kind], NiconicoSizes[size], NiconicoColors[color]) if i]
+
+
+def GenerateNiconico(count, profile, rng):
+    res = ['<?xml version="1.0" encoding="UTF-8"?><packet><thread resultcode="0" thread="1"/>']
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append('<chat thread="1" no="%d" vpos="%d" date="%d" mail="%s">%s</chat>' % (i + 1, timeline * 100, timestamp, ' '.join(['184'] + GenerateNiconicoMail(kind, size, color)), XMLEscape('\n'.join(lines))))
+    res.append('</packet>')
+    return ''.join(res)
+
+
+def GenerateNiconicoYtdlpJson(count, profile, rng):
+    res = [{'ping': {'content': 'rs:0'}}]
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append({'chat': {'thread': '1', 'no': i + 1, 'vpos': int(timeline * 100), 'date': timestamp, 'mail': ' '.join(GenerateNiconicoMail(kind, size, color)), 'content': '\n'.join(lines)}})
+    return json.dumps(res, ensure_ascii=False)
+
+
+def GenerateNiconicoYtdlpJson2(count, profile, rng):
+    res = []
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append({'id': '%d' % i, 'no': i + 1, 'vposMs': int(timeline * 1000), 'body': '\n'.join(lines), 'commands': ['184'] + GenerateNiconicoMail(kind, size, color), 'postedAt': time.strftime('%Y-%m-%dT%H:%M:%S+09:00', time.gmtime(timestamp))})
+    return json.dumps(res, ensure_ascii=False)
+
+
+def GenerateAcfun(count, profile, rng):
+    AcfunModes = {'scroll': '1', 'reverse': '2', 'bottom': '4', 'top': '5', 'positioned': '7'}
+    res = []
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        if kind == 'positioned':
+            text = json.dumps({'n': '\r'.join(lines), 'p': {'x': rng.randint(0, 1000), 'y': rng.randint(0, 1000)}, 'a': 0.8, 'r': rng.choice((0, 30)), 'k': rng.choice((0, 15)), 'l': 2.0, 'z': [{'x': rng.randint(0, 1000), 'y': rng.randint(0, 1000), 'l': 1.0, 'd': 45}, {'c': 0xff0000, 't': 0.5, 'l': 1.0}]}, ensure_ascii=False)
+        else:
+            text = '\r'.join(lines)
+        res.append({'c': '%.3f,%d,%s,%d,%08x,%d' % (timeline, color, AcfunModes[kind], size, i, timestamp), 'm': text})
+    return json.dumps([[], [], res], ensure_ascii=False)
+
+
+TudouPositions = {'scroll': 3, 'reverse': 3, 'bottom': 4, 'top': 6, 'positioned': 6}
+TudouSizes = {18: 0, 25: 1, 36: 2}
+
+
+def GenerateTudou(count, profile, rng):
+    res = []
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append({'pos': TudouPositions[kind], 'data': '\n'.join(lines), 'size': TudouSizes[size], 'replay_time': int(timeline * 1000), 'commit_time': timestamp, 'color': color})
+    return '{"status_code":0,"comment_list":%s}' % json.dumps(res, ensure_ascii=False)
+
+
+def GenerateTudou2(count, profile, rng):
+    res = []
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append({'content': '\n'.join(lines), 'propertis': json.dumps({'size': TudouSizes[size], 'pos': TudouPositions[kind], 'color': color}), 'playat': int(timeline * 1000), 'createtime': timestamp * 1000})
+    return '{"result":%s}' % json.dumps(res, ensure_ascii=False)
+
+
+def GenerateMioMio(count, profile, rng):
+    MioMioModes = {'scroll': '1', 'reverse': '1', 'bottom': '4', 'top': '5', 'positioned': '5'}
+    res = ['<?xml version="1.0" encoding="UTF-8"?>\n<flashdata>']
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append('<data><playTime>%.2f</playTime><message fontsize="%d" color="%d" mode="%s">%s</message><times>%s</times></data>' % (timeline, size, color, MioMioModes[kind], XMLEscape('\n'.join(lines)), time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))))
+    res.append('</flashdata>')
+    return ''.join(res)
+
+
+def GenerateDanDanPlay(count, profile, rng):
+    DanDanPlayModes = {'scroll': 1, 'reverse': 1, 'top': 4, 'bottom': 5, 'positioned': 4}
+    res = []
+    for i, (timeline, kind, lines, size, color, timestamp) in enumerate(GenerateComments(count, profile, rng)):
+        res.append({'cid': timestamp, 'p': '%.2f,%d,%d,%08x' % (timeline, DanDanPlayModes[kind], color, i), 'm': '\n'.join(lines)})
+    return json.dumps({'count': len(res), 'comments': res}, ensure_ascii=False)
+
+
+GeneratorMap = {
+    'Niconico': GenerateNiconico,
+    'NiconicoYtdlpJson': GenerateNiconicoYtdlpJson,
+    'NiconicoYtdlpJson2': GenerateNiconicoYtdlpJson2,
+    'Acfun': GenerateAcfun,
+    'Bilibili': GenerateBilibili,
+    'Bilibili2': GenerateBilibili2,
+    'Tudou': GenerateTudou,
+    'Tudou2': GenerateTudou2,
+    'MioMio': GenerateMioMio,
+    'DanDanPlay': GenerateDanDanPlay
+}
+
+
+def RunPhases(data, input_format, width, height, font_size):
+    timings = []
+
+    def Phase(name, function, *args):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        res = function(*args)
+        timings.append((name, time.perf_counter() - start_wall, time.process_time() - start_cpu))
+        return res
+
+    f = io.StringIO(data)
+    detected_format = Phase('probe', danmaku2ass.ProbeCommentFormat, f)
+    assert detected_format == input_format, (detected_format, input_format)
+    comments = Phase('parse', lambda: list(danmaku2ass.CommentFormatMap[input_format](danmaku2ass.FilterBadChars(f), font_size)))
+    count = len(comments)
+    table = Phase('sort', lambda: danmaku2ass.CommentTable(comments))
+    Phase('sort', table.sort)
+    del comments
+    output = io.StringIO()
+    Phase('layout', danmaku2ass.ProcessComments, table, output, width, height, 0, 'sans-serif', font_size, 1.0, 5.0, 5.0, [], False, None)
+    with tempfile.TemporaryFile('w', encoding='utf-8-sig', errors='replace', newline='\r\n') as fo:
+        Phase('write', fo.write, output.getvalue())
+    res = {}
+    for name, wall_time, cpu_time in timings:
+        wall_total, cpu_total = res.get(name, (0.0, 0.0))
+        res[name] = (wall_total + wall_time, cpu_total + cpu_time)
+    return count, res
+
+
+def MeasurePeakMemory(data, input_format, width, height, font_size):
+    tracemalloc.start()
+    try:
+        RunPhases(data, input_format, width, height, font_size)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Danmaku2ASS with synthetic comment files')
+    parser.add_argument('-n', '--count', metavar='N', help='Number of comments per file [default: %(default)s]', type=int, default=10000)
+    parser.add_argument('-f', '--format', metavar='FORMAT', action='append', choices=sorted(GeneratorMap), help='Comment format to benchmark, may be repeated [default: all]')
+    parser.add_argument('-p', '--profile', metavar='PROFILE', action='append', choices=sorted(Profiles), help='Profile to benchmark, may be repeated (%s) [default: all]' % '|'.join(sorted(Profiles)))
+    parser.add_argument('-s', '--size', metavar='WIDTHxHEIGHT', help='Stage size in pixels [default: %(default)s]', default='1920x1080')
+    parser.add_argument('-r', '--repeat', metavar='N', help='Keep the best of N runs [default: %(default)s]', type=int, default=3)
+    parser.add_argument('--seed', help='Random seed of the generators [default: %(default)s]', type=int, default=0)
+    parser.add_argument('--no-memory', action='store_true', help='Do not measure peak memory')
+    parser.add_argument('--baseline', metavar='FILE', help='Fail if any phase is slower than in this baseline')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Save the results as a baseline')
+    parser.add_argument('--tolerance', metavar='RATIO', help='Allowed slowdown against the baseline [default: %(default)s]', type=float, default=0.25)
+    parser.add_argument('--min-time', metavar='SECONDS', help='Do not compare phases faster than this in the baseline [default: %(default)s]', type=float, default=0.005)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.CRITICAL)
+    width, height = (int(i) for i in args.size.split('x', 1))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    results = {}
+    regressions = []
+    print('%-30s %8s %8s %8s %8s %8s %8s %12s %10s' % ('benchmark', 'probe', 'parse', 'sort', 'layout', 'write', 'total', 'comments/s', 'peak KiB'))
+    for input_format in args.format or list(GeneratorMap):
+        for profile in args.profile or sorted(Profiles):
+            name = '%s/%s' % (input_format, profile)
+            data = GeneratorMap[input_format](args.count, Profiles[profile], random.Random(args.seed))
+            best = {}
+            for i in range(max(args.repeat, 1)):
+                count, timings = RunPhases(data, input_format, width, height, 25.0)
+                for phase, (wall_time, cpu_time) in timings.items():
+                    if phase not in best or wall_time < best[phase][0]:
+                        best[phase] = (wall_time, cpu_time)
+            total = sum(wall_time for wall_time, cpu_time in best.values())
+            peak = None if args.no_memory else MeasurePeakMemory(data, input_format, width, height, 25.0)
+            results[name] = {'count': count, 'phases': {phase: {'wall': wall_time, 'cpu': cpu_time} for phase, (wall_time, cpu_time) in best.items()}, 'peak_memory': peak}
+            print('%-30s %8.3f %8.3f %8.3f %8.3f %8.3f %8.3f %12.0f %10s' % (name, best['probe'][0], best['parse'][0], best['sort'][0], best['layout'][0], best['write'][0], total, count / total if total else 0, '-' if peak is None else '%d' % (peak // 1024)))
+            if baseline and name in baseline:
+                for phase, (wall_time, cpu_time) in best.items():
+                    try:
+                        base_time = baseline[name]['phases'][phase]['wall']
+                    except KeyError:
+                        continue
+                    if base_time >= args.min_time and wall_time > base_time * (1 + args.tolerance):
+                        regressions.append('%s %s: %.3fs, baseline %.3fs' % (name, phase, wall_time, base_time))
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
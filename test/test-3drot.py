@@ -1,8 +1,25 @@
 #!/usr/bin/env python3
 
+# Benchmark ConvertFlashRotation against ReferenceFlashRotation, the plain
+# computation it replaced, and check that both give the same results.
+#
+# The sweep goes through every whole rotation at a few positions and never
+# repeats a transform soon enough to hit a cache, the worst case.  The
+# scatter places each rotation at many positions, like the comments of an
+# art piece sharing a rotation, and hits the cache of the angles.  The
+# replay repeats the keyframes of a few animated comments many times and
+# hits the cache of whole transforms.
+#
+#     ./test-3drot.py [--check-matrix]
+#
+# Exits with 1 if any result differs.  With --check-matrix, each result of
+# the sweep is also compared with the rotation matrix it stands for.
+
 import logging
 import math
+import random
 import sys
+import time
 
 try:
     import importlib.machinery
@@ -16,13 +33,80 @@ extcode = 0
 
 def main():
     logging.basicConfig(level=logging.INFO)
-    for Y in (120, 360):
-        for X in (160, 480):
-            for rotY in range(0, 361):
-                for rotZ in range(0, 361):
-                    trX, trY, outX, outY, outZ, scaleX, scaleY = danmaku2ass.ConvertFlashRotation(rotY, rotZ, X=X, Y=Y, width=640, height=480)
-                    logging.info('(%3d, %3d), %4d, %4d => %4d, %4d, %4d, %4d%%' % (X, Y, rotY, rotZ, outX, outY, outZ, scaleX))
-                    CompareMatrix(rotY, rotZ, outX, outY, outZ)
+    check_matrix = '--check-matrix' in sys.argv[1:]
+    sweep = [(rotY, rotZ, X, Y, 640, 480) for Y in (120, 360) for X in (160, 480) for rotY in range(0, 361) for rotZ in range(0, 361)]
+    rng = random.Random(0)
+    keyframes = [(rng.randint(-180, 180), rng.randint(-180, 180), rng.uniform(0, 1280), rng.uniform(0, 720), 1280, 720) for i in range(200)]
+    scatter = [(rotY, rotZ, rng.uniform(0, 1280), rng.uniform(0, 720), 1280, 720) for rotY in range(-180, 181, 15) for rotZ in range(-180, 181, 3) for i in range(180)]
+    replay = [rng.choice(keyframes) for i in range(len(sweep))]
+    for name, calls in (('sweep', sweep), ('scatter', scatter), ('replay', replay)):
+        danmaku2ass.ConvertFlashRotation.cache_clear()
+        danmaku2ass.FlashRotationAngles.cache_clear()
+        # Behind the camera errors are expected and would dominate the timing
+        logging.disable(logging.ERROR)
+        try:
+            reference, reference_time = TimeCalls(ReferenceFlashRotation, calls)
+            uncached, uncached_time = TimeCalls(danmaku2ass.ConvertFlashRotation.__wrapped__, calls)
+            cached, cached_time = TimeCalls(danmaku2ass.ConvertFlashRotation, calls)
+        finally:
+            logging.disable(logging.NOTSET)
+        logging.info('%-7s %7d calls: reference %.3fs, table %.3fs (%.2fx), table and cache %.3fs (%.2fx)' % (name, len(calls), reference_time, uncached_time, reference_time / uncached_time, cached_time, reference_time / cached_time))
+        CompareResults(name, calls, reference, uncached)
+        CompareResults(name, calls, reference, cached)
+    if check_matrix:
+        for args, result in zip(sweep, reference):
+            CompareMatrix(args[0], args[1], result[2], result[3], result[4])
+
+
+def TimeCalls(function, calls):
+    start = time.perf_counter()
+    results = [function(*args) for args in calls]
+    return results, time.perf_counter() - start
+
+
+def CompareResults(name, calls, expected, actual):
+    global extcode
+    for args, l, r in zip(calls, expected, actual):
+        if l != r:
+            extcode = 1
+            logging.error('%s: ConvertFlashRotation%r == %r, expected %r' % (name, args, r, l))
+
+
+def ReferenceFlashRotation(rotY, rotZ, X, Y, width, height):
+    # ConvertFlashRotation as it was before the sin/cos table and the cache
+    def WrapAngle(deg):
+        return 180 - ((180 - deg) % 360)
+    rotY = WrapAngle(rotY)
+    rotZ = WrapAngle(rotZ)
+    if rotY in (90, -90):
+        rotY -= 1
+    if rotY == 0 or rotZ == 0:
+        outX = 0
+        outY = -rotY  # Positive value means clockwise in Flash
+        outZ = -rotZ
+        rotY *= math.pi / 180.0
+        rotZ *= math.pi / 180.0
+    else:
+        rotY *= math.pi / 180.0
+        rotZ *= math.pi / 180.0
+        outY = math.atan2(-math.sin(rotY) * math.cos(rotZ), math.cos(rotY)) * 180 / math.pi
+        outZ = math.atan2(-math.cos(rotY) * math.sin(rotZ), math.cos(rotZ)) * 180 / math.pi
+        outX = math.asin(math.sin(rotY) * math.sin(rotZ)) * 180 / math.pi
+    trX = (X * math.cos(rotZ) + Y * math.sin(rotZ)) / math.cos(rotY) + (1 - math.cos(rotZ) / math.cos(rotY)) * width / 2 - math.sin(rotZ) / math.cos(rotY) * height / 2
+    trY = Y * math.cos(rotZ) - X * math.sin(rotZ) + math.sin(rotZ) * width / 2 + (1 - math.cos(rotZ)) * height / 2
+    trZ = (trX - width / 2) * math.sin(rotY)
+    FOV = width * math.tan(2 * math.pi / 9.0) / 2
+    try:
+        scaleXY = FOV / (FOV + trZ)
+    except ZeroDivisionError:
+        scaleXY = 1
+    trX = (trX - width / 2) * scaleXY + width / 2
+    trY = (trY - height / 2) * scaleXY + height / 2
+    if scaleXY < 0:
+        scaleXY = -scaleXY
+        outX += 180
+        outY += 180
+    return (trX, trY, WrapAngle(outX), WrapAngle(outY), WrapAngle(outZ), scaleXY * 100, scaleXY * 100)
 
 
 def CompareMatrix(rotY, rotZ, outX, outY, outZ):
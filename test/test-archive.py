@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Check that comments saved to an archive load back as the same comments,
+# whether the archive is mapped from a file or read from a stream, and
+# that converting the archive gives the same output as the original file.
+#
+#     ./test-archive.py
+#
+# Exits with 1 if anything differs.
+
+import io
+import logging
+import os
+import sys
+import tempfile
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    # Invalid comments of the test file are expected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        comments = danmaku2ass.ReadComments('issue-9-test.xml', 'autodetect')
+        # Columns of every kind: texts, JSON values and coded values
+        extra = [(1.5, '2014-01-01T00:00:00Z', 0, {'x': 1}, 'acfunpos', 0xffffff, 25.0, 0, 0), (2.5, '2014-01-01T00:00:01Z', 1, 'a\ud800b', 0, 0xffffff, 25.0, 25.0, 75.0)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'comments.d2a')
+            danmaku2ass.WriteCommentArchive(comments, path)
+            Compare('mapped', list(comments), list(danmaku2ass.LoadCommentArchive(path)))
+            CompareSlices('table', list(comments), comments)
+            CompareSlices('mapped', list(comments), danmaku2ass.LoadCommentArchive(path))
+            with open(path, 'rb') as f:
+                data = f.read()
+            Compare('stream', list(comments), list(danmaku2ass.LoadCommentArchive(io.BytesIO(data))))
+            Compare('autodetect', list(comments), list(danmaku2ass.ReadComments(path, 'autodetect')))
+            danmaku2ass.WriteCommentArchive(extra, path)
+            Compare('mixed columns', extra, list(danmaku2ass.LoadCommentArchive(path)))
+            CompareSlices('mixed columns', extra, danmaku2ass.LoadCommentArchive(path))
+            danmaku2ass.WriteCommentArchive(comments, path)
+            expected = io.StringIO()
+            actual = io.StringIO()
+            danmaku2ass.Converter(styleid='Danmaku2ASS_test').Convert(['issue-9-test.xml'], 'autodetect', [(1280, 720, expected)])
+            danmaku2ass.Converter(styleid='Danmaku2ASS_test').Convert([path], 'autodetect', [(1280, 720, actual)])
+            Compare('conversion', expected.getvalue(), actual.getvalue())
+            # Archives are mapped, the comment cache is not even opened
+            cache_dir = os.path.join(tmpdir, 'cache')
+            Compare('cached', list(comments), list(danmaku2ass.ReadComments(path, 'autodetect', cache_dir=cache_dir)))
+            Compare('cache directory', False, os.path.exists(cache_dir))
+    finally:
+        handler.setLevel(logging.NOTSET)
+    logging.info('%d comments archived' % len(comments))
+
+
+def Compare(name, expected, actual):
+    global extcode
+    if expected != actual:
+        extcode = 1
+        logging.error('%s differs after archiving' % name)
+
+
+def CompareSlices(name, expected, table):
+    # Slices of a table are lists of comments, as slices of the list are
+    for index in (slice(None), slice(1, 4), slice(-3, None), slice(None, None, 2), slice(5, 2), slice(-1, 0, -3)):
+        Compare('%s[%s:%s:%s]' % (name, index.start, index.stop, index.step), expected[index], table[index])
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
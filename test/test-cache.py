@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Check that comments cached by the command line are loaded back by the
+# Python API, which runs the module under another name, as the comments
+# read from the file.
+#
+#     ./test-cache.py
+#
+# Exits with 1 if anything differs.
+
+import logging
+import subprocess
+import sys
+import tempfile
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    # Invalid comments of the test file are expected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            subprocess.run([sys.executable, '../danmaku2ass.py', '-sa', tmpdir + '/unused.d2a', '-c', tmpdir + '/cache', 'issue-9-test.xml'], check=True, stderr=subprocess.DEVNULL)
+            stats = danmaku2ass.ConversionStats()
+            cached = danmaku2ass.ReadComments('issue-9-test.xml', 'autodetect', stats=stats, cache_dir=tmpdir + '/cache')
+            if not stats.cache_hit:
+                extcode = 1
+                logging.error('Comments cached by the command line are not loaded')
+            if list(cached) != list(danmaku2ass.ReadComments('issue-9-test.xml', 'autodetect')):
+                extcode = 1
+                logging.error('Cached comments differ from the ones read')
+    finally:
+        handler.setLevel(logging.NOTSET)
+    logging.info('%d comments cached' % len(cached))
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
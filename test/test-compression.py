@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Check that compressed comment files are read as the plain ones, for every
+# compression told apart by DecompressStream, and that short plain inputs
+# are not taken for raw deflate streams.
+#
+#     ./test-compression.py
+#
+# Exits with 1 if anything differs.
+
+import bz2
+import gzip
+import io
+import logging
+import lzma
+import sys
+import zlib
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+
+def Deflate(data, level=9, wbits=-zlib.MAX_WBITS):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+Compressions = {
+    'gzip': gzip.compress,
+    'bzip2': bz2.compress,
+    'xz': lzma.compress,
+    'zlib': zlib.compress,
+    'zlib, fastest': lambda data: zlib.compress(data, 1),
+    'raw deflate': Deflate,
+    'raw deflate, fastest': lambda data: Deflate(data, 1),
+    'raw deflate, stored': lambda data: Deflate(data, 0),
+}
+
+# Plain inputs as short as a raw deflate stream could be
+ShortInputs = [b'', b'x', b'x\n', b'ab', b'\x00\x00', b'0123456789', b'hello world\n']
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    with open('issue-9-test.xml', 'rb') as f:
+        plain = f.read()
+    # Invalid comments of the test file are expected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        expected = list(danmaku2ass.ReadComments([io.BytesIO(plain)], 'autodetect'))
+        for name, compress in Compressions.items():
+            data = compress(plain)
+            Compare(name, plain, Decompress(data))
+            Compare(name + ' comments', expected, list(danmaku2ass.ReadComments([io.BytesIO(data)], 'autodetect')))
+    finally:
+        handler.setLevel(logging.NOTSET)
+    for data in ShortInputs:
+        try:
+            Compare('plain %r' % data, data, Decompress(data))
+        except EOFError:
+            extcode = 1
+            logging.error('plain %r is taken for a compressed file' % data)
+        Compare('short raw deflate of %r' % data, data, Decompress(Deflate(data)))
+    for name in ('zlib', 'raw deflate'):
+        try:
+            Decompress(Compressions[name](plain)[:-8])
+        except EOFError:
+            continue
+        extcode = 1
+        logging.error('Truncated %s is read without an error' % name)
+    logging.info('%d compressions checked' % len(Compressions))
+
+
+def Decompress(data):
+    return danmaku2ass.DecompressStream(io.BufferedReader(io.BytesIO(data))).read()
+
+
+def Compare(name, expected, actual):
+    global extcode
+    if expected != actual:
+        extcode = 1
+        logging.error('%s is not read as the original' % name)
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
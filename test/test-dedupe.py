@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Check that --dedupe reads overlapping snapshots of the same comments as
+# their union, for Acfun files with positioned comments and for Bilibili
+# files, whose comments are told apart by their row ids.  Comments repeated
+# within one file are all kept.
+#
+#     ./test-dedupe.py
+#
+# Exits with 1 if anything differs.
+
+import io
+import json
+import logging
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+# The same comment twice, which Acfun tells apart by nothing
+AcfunComments = [
+    {'c': '1.5,16777215,1,25,u,1400000000', 'm': 'first'},
+    {'c': '2.5,16777215,7,25,u,1400000001', 'm': json.dumps({'n': 'positioned', 'p': {'x': 100, 'y': 100}, 'l': 4.5})},
+    {'c': '3.5,16777215,1,25,u,1400000002', 'm': 'same'},
+    {'c': '3.5,16777215,1,25,u,1400000002', 'm': 'same'},
+    {'c': '4.5,16777215,5,25,u,1400000003', 'm': 'later'},
+]
+
+# Two comments with the same time and text, told apart by their row ids
+BilibiliComments = [
+    '<d p="1.5,1,25,16777215,1400000000,0,abc,101">first</d>',
+    '<d p="2.5,7,25,16777215,1400000001,0,abc,102">[0,0,"1-1",4.5,"positioned",0,0,100,100,500,0,true]</d>',
+    '<d p="3.5,1,25,16777215,1400000002,0,abc,103">same</d>',
+    '<d p="3.5,1,25,16777215,1400000002,0,def,104">same</d>',
+    '<d p="4.5,5,25,16777215,1400000003,0,abc,105">later</d>',
+]
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    Check('Acfun', Acfun(AcfunComments[:4]), Acfun(AcfunComments[1:]), len(AcfunComments))
+    Check('Bilibili', Bilibili(BilibiliComments[:4]), Bilibili(BilibiliComments[1:]), len(BilibiliComments))
+
+
+def Check(name, first, second, expected):
+    global extcode
+    stats = danmaku2ass.ConversionStats()
+    comments = danmaku2ass.ReadComments([io.BytesIO(first), io.BytesIO(second)], 'autodetect', stats=stats, dedupe=True)
+    union = danmaku2ass.ReadComments([io.BytesIO(first), io.BytesIO(second)], 'autodetect')
+    if len(comments) != expected:
+        extcode = 1
+        logging.error('%s: %d comments read instead of %d' % (name, len(comments), expected))
+    if len(union) - len(comments) != stats.duplicates:
+        extcode = 1
+        logging.error('%s: %d duplicates counted instead of %d' % (name, stats.duplicates, len(union) - len(comments)))
+    # Comments come out as without --dedupe, numbered by their position
+    union = list(union)
+    if any(c not in union for c in comments):
+        extcode = 1
+        logging.error('%s: comments read differ from the ones without --dedupe' % name)
+    logging.info('%s: %d comments, %d duplicates' % (name, len(comments), stats.duplicates))
+
+
+def Acfun(comments):
+    return json.dumps([[], [], comments]).encode('utf-8')
+
+
+def Bilibili(comments):
+    return ('<?xml version="1.0" encoding="UTF-8"?><i>%s</i>' % ''.join(comments)).encode('utf-8')
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Check that IncrementalConverter, fed the comments of a file a few at a
+# time, writes the lines of a conversion of the whole file, and that a
+# converter restored from a checkpoint goes on as the original one does.
+#
+#     ./test-incremental.py
+#
+# Exits with 1 if anything differs.
+
+import io
+import logging
+import pickle
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    # Invalid comments of the test file are expected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        comments = list(danmaku2ass.ReadComments('issue-9-test.xml', 'autodetect'))
+        for size in (1, 7, 50):
+            chunks = [comments[k:k + size] for k in range(0, len(comments), size)]
+            original = danmaku2ass.IncrementalConverter(1280, 720, comment_filter='ww')
+            expected = original.Header()
+            for chunk in chunks:
+                expected += original.Convert(chunk)
+            full = io.StringIO()
+            danmaku2ass.Converter(comment_filter='ww', styleid=original.stage.styleid).Convert(['issue-9-test.xml'], 'autodetect', [(1280, 720, full)])
+            if expected.replace('\r\n', '\n') != full.getvalue().replace('\r\n', '\n'):
+                extcode = 1
+                logging.error('Chunks of %d comments differ from a conversion of the whole file' % size)
+            # Go on from a restored checkpoint before each chunk
+            converter = danmaku2ass.IncrementalConverter(1280, 720, comment_filter='ww')
+            converter.stage.styleid = original.stage.styleid
+            actual = converter.Header()
+            for chunk in chunks:
+                converter = danmaku2ass.IncrementalConverter.Restore(converter.Checkpoint())
+                actual += converter.Convert(chunk)
+            if actual != expected or vars(converter.stats) != vars(original.stats):
+                extcode = 1
+                logging.error('Chunks of %d comments differ after restoring checkpoints' % size)
+    finally:
+        handler.setLevel(logging.NOTSET)
+    try:
+        danmaku2ass.IncrementalConverter.Restore(pickle.dumps(None))
+    except ValueError:
+        pass
+    else:
+        extcode = 1
+        logging.error('A checkpoint of something else is restored')
+    logging.info('%d comments converted' % len(comments))
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Check that formatting the output in worker processes gives the same
+# outputs, counters and log messages as formatting it in one process.
+#
+#     ./test-jobs.py [JOBS]
+#
+# Exits with 1 if anything differs.
+
+import io
+import logging
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+# Worker processes that are not forked import danmaku2ass by name
+sys.path.insert(0, '..')
+
+extcode = 0
+
+# Positioned comments, one of them invalid, are formatted in the workers too
+PositionedComments = '''<?xml version="1.0" encoding="UTF-8"?><i>
+<d p="1.5,7,25,16777215,1400000000,0,0,0">[0,0,"1-1",4.5,"positioned",0,0,100,100,500,0,true]</d>
+<d p="2.5,7,25,16777215,1400000001,0,0,0">[broken</d>
+</i>'''.encode('utf-8')
+
+
+class Messages(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    # Invalid comments of the test file are expected, only show errors while
+    # they are still collected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        expected = Convert(1)
+        actual = Convert(jobs)
+    finally:
+        handler.setLevel(logging.NOTSET)
+    for name, l, r in zip(('Outputs', 'Counters', 'Log messages'), expected, actual):
+        if l != r:
+            extcode = 1
+            logging.error('%s differ with %d jobs' % (name, jobs))
+    logging.info('%d log messages, %d jobs' % (len(expected[2]), jobs))
+
+
+def Convert(jobs):
+    messages = Messages()
+    logging.getLogger().addHandler(messages)
+    try:
+        outputs = [io.StringIO(), io.StringIO()]
+        converter = danmaku2ass.Converter(comment_filter='ww', jobs=jobs, styleid='Danmaku2ASS_test')
+        stats = converter.Convert(['issue-9-test.xml', io.BytesIO(PositionedComments)], 'autodetect', [(1280, 720, outputs[0]), (640, 480, outputs[1])])
+    finally:
+        logging.getLogger().removeHandler(messages)
+    counters = (stats.placed, stats.overflow, stats.reduced, stats.targets, stats.filtered, stats.positioned, stats.invalid, stats.filter_counts)
+    return [f.getvalue() for f in outputs], counters, messages.messages
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
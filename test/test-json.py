@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Check that JSON arrays decoded one element at a time give the same values
+# as json.loads, wherever the chunks read from the file happen to split
+# numbers, strings, escapes and separators.
+#
+#     ./test-json.py
+#
+# Exits with 1 if anything differs.
+
+import io
+import json
+import logging
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+# (document, path to the array, path to the same array in json.loads)
+Documents = [
+    ('[]', (), ()),
+    ('[1, -2.5e-3, 1234567890123, 0, true, false, null]', (), ()),
+    (' [ "a\\"b" , "\\u3042\\ud83d\\ude00" ,"/n\\\\" ] ', (), ()),
+    ('[[], [], [{"c": "8.863,16711680,2,18,u,1400000000", "m": "2333333"}, {"c": "1,2", "m": "{\\"x\\": [1, 2]}"}]]', (2,), (2,)),
+    ('{"total": 2, "comment_list": [{"replay_time": 1500, "data": "草"}, {"replay_time": 12, "data": "]},"}]}', ('comment_list',), ('comment_list',)),
+    ('{"a": {"comment_list": 1}, "b": [1, [2]], "comment_list": [10, 20]}', ('comment_list',), ('comment_list',)),
+    ('{"total": 123456, "x": -1.5e10, "comment_list": [1]}', ('comment_list',), ('comment_list',)),
+    ('[{"chat": {"vpos": 76, "content": "1", "date": 1402132048, "no": 1}}, {"chat": {"vpos": 1563, "content": "\\n", "mail": "184 big", "no": 2}}]', (), ()),
+]
+
+Malformed = ['[1, 2', '[1 2]', '{"comment_list": 5}', '[1,]', '']
+
+
+class ChunkedReader(io.StringIO):
+    # Read at most size characters at a time, whatever is asked for
+
+    def __init__(self, text, size):
+        super().__init__(text)
+        self.size = size
+
+    def read(self, size=-1):
+        return super().read(self.size if size < 0 else min(size, self.size))
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    checked = 0
+    for document, path, loads_path in Documents:
+        expected = json.loads(document)
+        for key in loads_path:
+            expected = expected[key]
+        for size in list(range(1, 10)) + [65536]:
+            try:
+                actual = list(danmaku2ass.IterJSONArray(ChunkedReader(document, size), path))
+            except ValueError as e:
+                actual = e
+            if actual != expected:
+                extcode = 1
+                logging.error('%r read %d characters at a time gives %r' % (document, size, actual))
+            checked += 1
+    for document in Malformed:
+        for size in (1, 3, 65536):
+            try:
+                actual = list(danmaku2ass.IterJSONArray(ChunkedReader(document, size), ('comment_list',) if document.startswith('{') else ()))
+            except (ValueError, KeyError, IndexError):
+                continue
+            extcode = 1
+            logging.error('%r read %d characters at a time gives %r' % (document, size, actual))
+    logging.info('%d documents checked' % checked)
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
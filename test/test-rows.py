@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# Check that the interval lane allocator places every comment on the same
+# row as the original allocator, which kept one slot per pixel row.
+#
+#     ./test-rows.py
+#
+# Exits with 1 if any placement differs.
+
+import logging
+import math
+import random
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+DurationMarquee = 5.0
+DurationStill = 5.0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    # Invalid comments of the test file are expected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        samples = {'issue-9-test.xml': list(danmaku2ass.ReadComments('issue-9-test.xml', 'autodetect')), 'dense': Generate(random.Random(1), 5000)}
+    finally:
+        handler.setLevel(logging.NOTSET)
+    checked = 0
+    for name, comments in samples.items():
+        comments = [c for c in comments if isinstance(c[4], int)]
+        for width, height, bottomReserved in ((640, 480, 0), (1280, 720, 50), (320, 60, 0)):
+            for reduced in (False, True):
+                expected = PlaceOriginal(comments, width, height, bottomReserved, reduced)
+                actual = PlaceIntervals(comments, width, height, bottomReserved, reduced)
+                if actual != expected:
+                    extcode = 1
+                    k = next(k for k, (l, r) in enumerate(zip(expected, actual)) if l != r)
+                    logging.error('%s at %dx%d, reserved %d, reduced %s: comment %d placed on row %r instead of %r' % (name, width, height, bottomReserved, reduced, k, actual[k], expected[k]))
+                checked += len(comments)
+    logging.info('%d placements checked' % checked)
+
+
+def Generate(rng, count):
+    # Crowded comments of every type, some of them taller than small stages
+    comments = []
+    for k in range(count):
+        size = rng.choice((16.0, 25.0, 36.0))
+        lines = rng.choice((1, 1, 1, 3))
+        width = rng.choice((0.0, size * rng.randint(1, 40)))
+        comments.append((rng.uniform(0, 60), k, k, 'x', rng.randint(0, 3), 0xffffff, size, lines * size, width))
+    comments.sort(key=danmaku2ass.CommentSortKey)
+    return comments
+
+
+def PlaceIntervals(comments, width, height, bottomReserved, reduced):
+    stage = danmaku2ass.Stage(None, width, height, bottomReserved, 'test')
+    lengths, stage_times = danmaku2ass.PrecomputeLayout([c[0] for c in comments], [c[4] for c in comments], [c[7] for c in comments], [c[8] for c in comments], [width], DurationMarquee, DurationStill)
+    thresholds, releases = stage_times[0]
+    placements = []
+    for k, c in enumerate(comments):
+        row = danmaku2ass.FindFreeRow(stage.rows, c, height, bottomReserved, lengths[k], thresholds[k])
+        if row is None and not reduced:
+            row = danmaku2ass.FindAlternativeRow(stage.rows, c, height, bottomReserved, lengths[k])
+        if row is not None:
+            danmaku2ass.MarkCommentRow(stage.rows, c, row, lengths[k], releases[k])
+        placements.append(row)
+    return placements
+
+
+def PlaceOriginal(comments, width, height, bottomReserved, reduced):
+    # The allocator of earlier versions, as it was
+    rows = [[None] * (height - bottomReserved + 1) for i in range(4)]
+    placements = []
+    for c in comments:
+        row = 0
+        rowmax = height - bottomReserved - c[7]
+        while row <= rowmax:
+            freerows = TestFreeRows(rows, c, row, width, height, bottomReserved)
+            if freerows >= c[7]:
+                MarkCommentRow(rows, c, row)
+                break
+            else:
+                row += freerows or 1
+        else:
+            if not reduced:
+                row = FindAlternativeRow(rows, c, height, bottomReserved)
+                MarkCommentRow(rows, c, row)
+            else:
+                row = None
+        placements.append(row)
+    return placements
+
+
+def TestFreeRows(rows, c, row, width, height, bottomReserved):
+    res = 0
+    rowmax = height - bottomReserved
+    targetRow = None
+    if c[4] in (1, 2):
+        while row < rowmax and res < c[7]:
+            if targetRow != rows[c[4]][row]:
+                targetRow = rows[c[4]][row]
+                if targetRow and targetRow[0] + DurationStill > c[0]:
+                    break
+            row += 1
+            res += 1
+    else:
+        try:
+            thresholdTime = c[0] - DurationMarquee * (1 - width / (c[8] + width))
+        except ZeroDivisionError:
+            thresholdTime = c[0] - DurationMarquee
+        while row < rowmax and res < c[7]:
+            if targetRow != rows[c[4]][row]:
+                targetRow = rows[c[4]][row]
+                try:
+                    if targetRow and (targetRow[0] > thresholdTime or targetRow[0] + targetRow[8] * DurationMarquee / (targetRow[8] + width) > c[0]):
+                        break
+                except ZeroDivisionError:
+                    pass
+            row += 1
+            res += 1
+    return res
+
+
+def FindAlternativeRow(rows, c, height, bottomReserved):
+    res = 0
+    for row in range(height - bottomReserved - math.ceil(c[7])):
+        if not rows[c[4]][row]:
+            return row
+        elif rows[c[4]][row][0] < rows[c[4]][res][0]:
+            res = row
+    return res
+
+
+def MarkCommentRow(rows, c, row):
+    try:
+        for i in range(row, row + math.ceil(c[7])):
+            rows[c[4]][i] = c
+    except IndexError:
+        pass
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# Check that importing danmaku2ass stays cheap.
+#
+# Modules only needed by some code paths (the command line parser,
+# translations, the JSON and XML parsers, the conversion server...) must be
+# imported where they are used, not when danmaku2ass is loaded.
+#
+#     ./test-startup.py [BUDGET_MS]
+#
+# Exits with 1 if one of them is imported or the cumulative import time of
+# danmaku2ass exceeds the budget [default: 50 ms].
+
+import logging
+import os
+import re
+import subprocess
+import sys
+
+HeavyModules = ('argparse', 'calendar', 'concurrent.futures', 'gettext', 'hashlib', 'heapq', 'http.client', 'http.server', 'importlib.metadata', 'json', 'pickle', 'random', 'signal', 'socket', 'socketserver', 'tempfile', 'urllib.parse', 'xml.etree.ElementTree')
+
+extcode = 0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 50.0
+    package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    script = 'import sys; sys.path.insert(0, %r); import danmaku2ass' % package_dir
+    # The first run writes the bytecode cache, as an installed copy would have
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    subprocess.run([sys.executable, '-c', script], env=env, check=True)
+    elapsed = None
+    for i in range(3):
+        imported = ImportTimes(script, env)
+        elapsed = min(elapsed, imported['danmaku2ass']) if elapsed is not None else imported['danmaku2ass']
+    for module in HeavyModules:
+        if module in imported:
+            extcode = 1
+            logging.error('%s is imported at startup' % module)
+    logging.info('import danmaku2ass: %.1f ms' % elapsed)
+    if elapsed > budget:
+        extcode = 1
+        logging.error('Import took longer than %.1f ms' % budget)
+
+
+def ImportTimes(script, env):
+    # Return {module: cumulative import time in ms}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imported = {}
+    for line in result.stderr.splitlines():
+        m = re.match(r'import time:\s*(\d+)\s*\|\s*(\d+)\s*\|\s*(\S+)', line)
+        if m:
+            imported[m.group(3).strip()] = int(m.group(2)) / 1000
+    return imported
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
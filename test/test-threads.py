@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# Check that conversions running at the same time in threads give the same
+# outputs and counters as when they run one after another.
+#
+# Converters with different width models, stage sizes and filters are used
+# by several threads each, so that any state shared between conversions
+# would leak into the outputs.
+#
+#     ./test-threads.py [THREADS]
+#
+# Exits with 1 if any output differs.
+
+import concurrent.futures
+import io
+import logging
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    with open('issue-9-test.xml', 'rb') as f:
+        data = f.read()
+    converters = [
+        danmaku2ass.Converter(width_model='eastasian', styleid='Danmaku2ASS_test'),
+        danmaku2ass.Converter(width_model='length', is_reduce_comments=True, styleid='Danmaku2ASS_test'),
+        danmaku2ass.Converter(font_size=36.0, comment_filter=['ww', '8+'], styleid='Danmaku2ASS_test'),
+    ]
+    tasks = [(converter, size) for converter in converters for size in ((640, 480), (1280, 720), (1920, 1080))] * 4
+    # Invalid comments of the test file are expected, only show errors while
+    # they are still counted
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        expected = [Convert(converter, data, size) for converter, size in tasks]
+        # Switch threads often, so that the conversions interleave.  Invalid
+        # comments must be counted even when warnings are not logged.
+        sys.setswitchinterval(1e-5)
+        logging.getLogger().setLevel(logging.ERROR)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            actual = list(executor.map(lambda task: Convert(task[0], data, task[1]), tasks))
+    finally:
+        logging.getLogger().setLevel(logging.INFO)
+        handler.setLevel(logging.NOTSET)
+    for k, (l, r) in enumerate(zip(expected, actual)):
+        if l != r:
+            extcode = 1
+            logging.error('Task %d differs when run in a thread' % k)
+    logging.info('%d conversions in %d threads' % (len(tasks), threads))
+
+
+def Convert(converter, data, size):
+    f = io.StringIO()
+    stats = converter.Convert([io.BytesIO(data)], 'autodetect', [size + (f,)])
+    return f.getvalue(), stats.placed, stats.overflow, stats.reduced, stats.filtered, stats.invalid, stats.filter_counts
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)
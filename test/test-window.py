@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# Check conversions of a time window against a full conversion.
+#
+# With an infinite warm-up, the lines written for a window must be those of
+# the full conversion for the comments in the window, and rebasing must only
+# move their times.
+#
+#     ./test-window.py
+#
+# Exits with 1 if anything differs.
+
+import io
+import logging
+import math
+import sys
+
+try:
+    import importlib.machinery
+    danmaku2ass = importlib.machinery.SourceFileLoader('danmaku2ass', '../danmaku2ass.py').load_module('danmaku2ass')
+except (AttributeError, ImportError):
+    import imp
+    danmaku2ass = imp.load_source('danmaku2ass', '../danmaku2ass..py')
+
+extcode = 0
+
+
+def main():
+    global extcode
+    logging.basicConfig(level=logging.INFO)
+    # Invalid comments of the test file are expected
+    handler = logging.getLogger().handlers[0]
+    handler.setLevel(logging.ERROR)
+    try:
+        comments = danmaku2ass.ReadComments('issue-9-test.xml', 'autodetect')
+        full = Convert()
+        windows = 0
+        for start, end in ((None, 20.0), (10.0, 30.0), (25.0, None), (1e9, None)):
+            lo = 0 if start is None else sum(1 for c in comments if c[0] < start)
+            hi = len(comments) if end is None else sum(1 for c in comments if c[0] < end)
+            expected = [line for k, line in full if lo <= k < hi]
+            actual = Convert(start=start, end=end, warmup=math.inf)
+            if [line for k, line in actual] != expected:
+                extcode = 1
+                logging.error('Window %r-%r differs from the full conversion' % (start, end))
+            rebased = Convert(start=start, end=end, rebase=True, warmup=math.inf)
+            if start is not None and [Shift(line, start) for k, line in rebased] != expected:
+                extcode = 1
+                logging.error('Window %r-%r is not rebased to %r' % (start, end, start))
+            if len(Convert(start=start, end=end)) != len(expected):
+                extcode = 1
+                logging.error('Window %r-%r with a warm-up writes other comments' % (start, end))
+            windows += 1
+    finally:
+        handler.setLevel(logging.NOTSET)
+    logging.info('%d windows checked' % windows)
+
+
+def Convert(**kwargs):
+    # Return [(index, Dialogue line)], every comment of the test file being
+    # written as one line
+    f = io.StringIO()
+    danmaku2ass.Converter(styleid='Danmaku2ASS_test', **kwargs).Convert(['issue-9-test.xml'], 'autodetect', [(1280, 720, f)])
+    lines = [line for line in f.getvalue().splitlines() if line.startswith('Dialogue:')]
+    return list(enumerate(lines))
+
+
+def Shift(line, offset):
+    fields = line.split(',', 3)
+    for k in (1, 2):
+        h, m, s = fields[k].split(':')
+        fields[k] = danmaku2ass.ConvertTimestamp(int(h) * 3600 + int(m) * 60 + float(s) + offset)
+    return ','.join(fields)
+
+if __name__ == '__main__':
+    main()
+    sys.exit(extcode)